@@ -5,6 +5,8 @@ import yaml
 import sys
 import os
 import argparse
+import hashlib
+import shutil
 import urllib.request
 from pathlib import Path
 from datetime import datetime
@@ -14,6 +16,13 @@ MAINTAINER = "Jerry Lin <jerry73204@gmail.com>"
 DESCRIPTION = "Autoware ML model data files"
 INSTALL_DIR = "/opt/autoware/data"
 
+# Content-addressed download cache shared by every tree on the build host
+CACHE_DIR_ENV = "AUTOWARE_DATA_CACHE"
+CACHE_SIZE_ENV = "AUTOWARE_DATA_CACHE_SIZE"
+DEFAULT_CACHE_SIZE = "50G"
+# aria2c input listing only the files the cache could not provide
+MISSING_DOWNLOADS = "downloads.missing.txt"
+
 # URL template for downloading tasks.yaml from Autoware repo
 TASKS_URL_TEMPLATE = "https://raw.githubusercontent.com/autowarefoundation/autoware/refs/tags/{version}/ansible/roles/artifacts/tasks/main.yaml"
 
@@ -87,7 +96,8 @@ def generate_control():
 Section: misc
 Priority: optional
 Maintainer: {MAINTAINER}
-Build-Depends: debhelper-compat (= 13), aria2, ca-certificates
+Build-Depends: debhelper-compat (= 13), aria2, ca-certificates, python3,
+ python3-yaml
 Standards-Version: 4.6.2
 
 Package: {PACKAGE_NAME}
@@ -116,6 +126,161 @@ def generate_aria2_input(downloads):
     return "\n".join(lines)
 
 
+def parse_aria2_input(text):
+    """Parse an aria2c input file into entries with url, dir, out and sha256.
+
+    Each entry keeps its original lines under 'block' so that a subset can be
+    written back unchanged.
+    """
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            entries.append({'url': line.strip(), 'dir': '.', 'out': '',
+                            'sha256': '', 'block': [line]})
+            continue
+        if not entries:
+            continue
+        entry = entries[-1]
+        entry['block'].append(line)
+        key, _, value = line.strip().partition('=')
+        if key in ('dir', 'out'):
+            entry[key] = value
+        elif key == 'checksum' and value.startswith('sha-256='):
+            entry['sha256'] = value.split('=', 1)[1]
+    return entries
+
+
+def default_cache_dir():
+    """Cache location: $AUTOWARE_DATA_CACHE or $XDG_CACHE_HOME/autoware-data."""
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'autoware-data'
+
+
+def parse_size(text):
+    """Parse a byte count with an optional binary K/M/G/T suffix."""
+    text = str(text).strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def sha256_file(path):
+    """Hash a file without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir, sha256):
+    return Path(cache_dir) / 'sha256' / sha256[:2] / sha256
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copying across file systems, replacing dst."""
+    tmp = dst.with_name(f".{dst.name}.tmp{os.getpid()}")
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def cache_link(entries, cache_dir, base_dir):
+    """Hardlink cached files into the build tree.
+
+    A file already present in the build tree with the expected checksum (e.g.
+    the small files tracked in git) is added to the cache instead. Returns the
+    entries which still have to be downloaded.
+    """
+    missing = []
+    hits = hit_bytes = 0
+    for entry in entries:
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        sha256 = entry['sha256']
+        if not sha256:
+            missing.append(entry)
+            continue
+        cached = _cache_path(cache_dir, sha256)
+        try:
+            if not (dest.exists() and os.path.samefile(cached, dest)):
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                _link_or_copy(cached, dest)
+            # the modification time orders the entries for eviction
+            os.utime(cached)
+            hits += 1
+            hit_bytes += dest.stat().st_size
+            continue
+        except FileNotFoundError:
+            pass
+        if dest.exists() and sha256_file(dest) == sha256:
+            _cache_add(cache_dir, sha256, dest)
+            continue
+        missing.append(entry)
+    print(f"Cache {cache_dir}: {hits} files ({hit_bytes / (1 << 30):.2f} GiB) "
+          f"linked, {len(missing)} to download")
+    return missing
+
+
+def _cache_add(cache_dir, sha256, path):
+    cached = _cache_path(cache_dir, sha256)
+    if cached.exists():
+        return
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    _link_or_copy(path, cached)
+
+
+def cache_store(entries, cache_dir, base_dir, max_size):
+    """Add downloaded files to the cache, then evict down to max_size bytes.
+
+    Files are verified before they are added, so a bad download never ends up
+    being shared with other builds.
+    """
+    for entry in entries:
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        sha256 = entry['sha256']
+        if not sha256 or not dest.exists():
+            continue
+        if _cache_path(cache_dir, sha256).exists():
+            continue
+        actual = sha256_file(dest)
+        if actual != sha256:
+            print(f"Warning: {dest} has sha256 {actual}, expected {sha256}; "
+                  "not caching it", file=sys.stderr)
+            continue
+        _cache_add(cache_dir, sha256, dest)
+    cache_evict(cache_dir, max_size)
+
+
+def cache_evict(cache_dir, max_size):
+    """Remove the least recently used cache entries beyond max_size bytes.
+
+    Files hardlinked into build trees stay valid there.
+    """
+    files = []
+    for path in (Path(cache_dir) / 'sha256').glob('*/*'):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        files.append((st.st_mtime, st.st_size, path))
+    total = sum(size for _, size, _ in files)
+    for _, size, path in sorted(files):
+        if total <= max_size:
+            break
+        path.unlink(missing_ok=True)
+        total -= size
+        print(f"Evicted {path.name} ({size / (1 << 20):.1f} MiB) from cache")
+
+
 def generate_rules(downloads):
     """Generate debian/rules content with aria2c for parallel downloads."""
     install_commands = []
@@ -147,8 +312,13 @@ export DH_VERBOSE = 1
 override_dh_auto_build:
 \t@echo "Creating download directories..."
 {chr(10).join(mkdir_commands)}
+\t@echo "Linking model files from the download cache..."
+\tpython3 genpkg.py --cache-link
 \t@echo "Downloading model files with aria2c..."
-\taria2c -i downloads.txt -j 8 --continue=true --auto-file-renaming=false --allow-overwrite=true
+\tif [ -s {MISSING_DOWNLOADS} ]; then \\
+\t\taria2c -i {MISSING_DOWNLOADS} -j 8 --continue=true --auto-file-renaming=false --allow-overwrite=true; \\
+\tfi
+\tpython3 genpkg.py --cache-store
 \t@echo "Downloads complete."
 
 override_dh_auto_install:
@@ -156,7 +326,7 @@ override_dh_auto_install:
 {chr(10).join(install_commands)}
 
 override_dh_auto_clean:
-\trm -rf downloads/
+\trm -rf downloads/ {MISSING_DOWNLOADS}
 
 override_dh_strip:
 \t# Skip stripping binary files (ONNX models)
@@ -287,6 +457,33 @@ Examples:
         help='Only download tasks.yaml, do not generate debian files'
     )
 
+    parser.add_argument(
+        '--cache-link',
+        action='store_true',
+        help='Build step: hardlink the files of downloads.txt from the download '
+             f'cache and list the rest in {MISSING_DOWNLOADS}'
+    )
+
+    parser.add_argument(
+        '--cache-store',
+        action='store_true',
+        help='Build step: add the verified downloads to the download cache and '
+             'evict the least recently used files beyond --cache-max-size'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        help=f'Download cache shared by all trees (default: ${CACHE_DIR_ENV} or '
+             '~/.cache/autoware-data)'
+    )
+
+    parser.add_argument(
+        '--cache-max-size',
+        default=os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE),
+        help=f'Size bound of the download cache (default: ${CACHE_SIZE_ENV} or '
+             f'{DEFAULT_CACHE_SIZE})'
+    )
+
     args = parser.parse_args()
 
     # Resolve paths
@@ -299,6 +496,26 @@ Examples:
     if not output_dir.is_absolute():
         output_dir = script_dir / output_dir
 
+    # Build steps around the download of downloads.txt
+    if args.cache_link or args.cache_store:
+        cache_dir = Path(args.cache_dir) if args.cache_dir else default_cache_dir()
+        entries = parse_aria2_input((output_dir / 'downloads.txt').read_text())
+        missing = entries
+        try:
+            if args.cache_link:
+                missing = cache_link(entries, cache_dir, output_dir)
+            else:
+                cache_store(entries, cache_dir, output_dir,
+                            parse_size(args.cache_max_size))
+        except OSError as e:
+            # the cache only saves time, never fail the build because of it
+            print(f"Warning: download cache {cache_dir} unusable: {e}",
+                  file=sys.stderr)
+        if args.cache_link:
+            (output_dir / MISSING_DOWNLOADS).write_text(
+                "\n".join("\n".join(e['block']) + "\n" for e in missing))
+        sys.exit(0)
+
     # Handle download-only mode
     if args.download_only:
         if not download_tasks_yaml(args.download_only, tasks_path):
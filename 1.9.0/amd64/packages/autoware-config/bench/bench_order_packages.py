@@ -0,0 +1,63 @@
+#!/usr/bin/env python3
+"""Benchmark order_packages() of _local_setup_util.py on synthetic prefixes.
+
+Prints the best-of-N time per package count together with the time per
+package, which stays flat when the ordering scales linearly.
+
+Examples:
+  ./bench_order_packages.py
+  ./bench_order_packages.py --sizes 500 2000 --baseline \\
+      ../../../../../1.7.1/amd64/packages/autoware-config/src/_local_setup_util.py
+"""
+
+import argparse
+import copy
+
+from benchlib import DEFAULT_UTIL, best_of, load_util, make_dependency_graph
+
+DEFAULT_SIZES = [500, 2000, 10000]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the topological ordering of setup packages")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+        help="Synthetic package counts (default: 500 2000 10000)")
+    parser.add_argument(
+        "--fanout", type=int, default=6,
+        help="Maximum runtime dependencies per package (default: 6)")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Runs per size, the fastest is reported (default: 3)")
+    parser.add_argument(
+        "--util", default=str(DEFAULT_UTIL),
+        help="_local_setup_util.py to benchmark (default: this tree's copy)")
+    parser.add_argument(
+        "--baseline",
+        help="Another _local_setup_util.py to compare against; its output "
+             "must be identical")
+    args = parser.parse_args()
+
+    utils = [("current", load_util(args.util, "util_current"))]
+    if args.baseline:
+        utils.append(("baseline", load_util(args.baseline, "util_baseline")))
+
+    print(f"{'packages':>9}  {'util':<8}  {'total [ms]':>11}  {'per pkg [us]':>12}")
+    for size in args.sizes:
+        graph = make_dependency_graph(size, args.fanout)
+        results = {}
+        for label, util in utils:
+            # order_packages() may consume its argument, hand it a fresh copy
+            elapsed = best_of(
+                util.order_packages, args.repeat,
+                setup=lambda: copy.deepcopy(graph))
+            results[label] = util.order_packages(copy.deepcopy(graph))
+            print(f"{size:>9}  {label:<8}  {elapsed * 1e3:>11.2f}  "
+                  f"{elapsed / size * 1e6:>12.2f}")
+        if len(results) > 1 and results["current"] != results["baseline"]:
+            raise SystemExit(f"Error: orderings differ for {size} packages")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""Compare the full Autoware environment with one scoped to a launch closure.
+
+Runs the prefix's _local_setup_util.py once for all packages and once with
+--packages-up-to (default: autoware_launch, which provides the planning
+simulator launch files) and reports the number of packages set up, the hook
+scripts left to source, the entries per path-like variable and the time spent
+generating the environment, scanning the ament index along
+AMENT_PREFIX_PATH and starting Python with the resulting PYTHONPATH.
+
+Examples:
+  ./bench_scoped_environment.py
+  ./bench_scoped_environment.py --prefix /opt/autoware/1.9.0 \\
+      --packages autoware_launch
+  ./bench_scoped_environment.py --synthetic 450
+"""
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchlib import DEFAULT_UTIL, best_of, copy_util, load_util, make_prefix
+
+PATH_VARIABLES = [
+    "AMENT_PREFIX_PATH", "PATH", "LD_LIBRARY_PATH", "PYTHONPATH",
+    "CMAKE_PREFIX_PATH",
+]
+RESOURCE_INDEX = "share/ament_index/resource_index/packages"
+
+
+def resolve_environment(util_path, shell, roots):
+    """Return the json output of the util, scoped to `roots` if given."""
+    argv = [sys.executable, str(util_path), "json", shell]
+    if roots:
+        for root in roots:
+            argv += ["--packages-up-to", root]
+    env = dict(os.environ, AUTOWARE_SETUP_NO_CACHE="1")
+    return json.loads(subprocess.check_output(argv, env=env))
+
+
+def scan_ament_index(ament_prefix_path):
+    """Emulate ament_index_python.get_packages_with_prefixes()."""
+    packages = {}
+    for prefix in reversed(ament_prefix_path.split(os.pathsep)):
+        index = os.path.join(prefix, RESOURCE_INDEX)
+        if os.path.isdir(index):
+            for name in os.listdir(index):
+                packages[name] = prefix
+    return packages
+
+
+def measure(util_path, shell, roots, repeat):
+    result = resolve_environment(util_path, shell, roots)
+    environ = dict(os.environ, **result["environment"])
+    stats = {
+        "scripts": len(result["scripts"]),
+        "util_ms": best_of(
+            lambda: resolve_environment(util_path, shell, roots), repeat) * 1e3,
+        "index_ms": best_of(
+            lambda: scan_ament_index(environ.get("AMENT_PREFIX_PATH", "")),
+            repeat) * 1e3,
+        "python_ms": best_of(
+            lambda: subprocess.run(
+                [sys.executable, "-c", "import json"], env=environ, check=True),
+            repeat) * 1e3,
+    }
+    for name in PATH_VARIABLES:
+        value = result["environment"].get(name)
+        stats[name] = len([v for v in value.split(os.pathsep) if v]) \
+            if value is not None else "-"
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare full and launch-scoped Autoware environments")
+    parser.add_argument(
+        "--prefix", default="/opt/autoware/1.9.0",
+        help="Install prefix with _local_setup_util.py (default: "
+             "/opt/autoware/1.9.0)")
+    parser.add_argument(
+        "--packages", nargs="+",
+        help="Root packages of the scoped environment (default: "
+             "autoware_launch, or the top package of a synthetic prefix)")
+    parser.add_argument(
+        "--synthetic", type=int, metavar="COUNT",
+        help="Benchmark a synthetic prefix with COUNT packages instead")
+    parser.add_argument(
+        "--shell", default="bash", help="Additional extension (default: bash)")
+    parser.add_argument(
+        "--repeat", type=int, default=5,
+        help="Runs per measurement, the fastest is reported (default: 5)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        roots = args.packages
+        if args.synthetic:
+            prefix = Path(tmp) / "prefix"
+            graph = make_prefix(prefix, args.synthetic)
+            copy_util(DEFAULT_UTIL, prefix)
+            # the last package depends on the most others
+            roots = roots or [list(graph)[-1]]
+        else:
+            prefix = Path(args.prefix)
+            roots = roots or ["autoware_launch"]
+        util_path = prefix / "_local_setup_util.py"
+        if not util_path.exists():
+            parser.error(f"{util_path} not found")
+
+        util = load_util(util_path)
+        packages = util.get_packages(prefix)
+        closure = util._helpers().get_package_closure(packages, roots)
+
+        rows = [
+            ("full", len(packages), measure(util_path, args.shell, None,
+                                            args.repeat)),
+            ("scoped", len(closure), measure(util_path, args.shell, roots,
+                                             args.repeat)),
+        ]
+
+    print(f"prefix: {prefix}, scoped to: {' '.join(roots)}")
+    columns = ["packages", "scripts", *PATH_VARIABLES,
+               "util_ms", "index_ms", "python_ms"]
+    widths = [max(len(c), 6) + 2 for c in columns]
+    print(f"{'':<8}" + "".join(f"{c:>{w}}" for c, w in zip(columns, widths)))
+    for label, count, stats in rows:
+        values = [count] + [stats[c] for c in columns[1:]]
+        print(f"{label:<8}" + "".join(
+            f"{v:>{w}.2f}" if isinstance(v, float) else f"{v:>{w}}"
+            for v, w in zip(values, widths)))
+
+
+if __name__ == "__main__":
+    main()
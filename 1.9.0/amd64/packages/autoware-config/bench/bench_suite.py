@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+"""Scaling benchmark of _local_setup_util.py and the local_setup scripts.
+
+Generates synthetic prefixes for each package count and times get_packages(),
+order_packages() and get_commands() in-process as well as sourcing
+local_setup.{sh,bash,zsh} end to end (with the setup cache disabled). Each
+util is benchmarked together with the local_setup scripts next to it, so the
+copies of the released trees can be compared on the same prefixes.
+
+Examples:
+  ./bench_suite.py --sizes 200 1000 --output results.json
+  ./bench_suite.py --releases --hook-type mixed --dsv-depth 3
+  ./bench_suite.py --util old=/tmp/_local_setup_util.py --compare results.json
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchlib import (
+    DEFAULT_UTIL, HOOK_TYPES, best_of, copy_util, load_util, make_prefix)
+
+DEFAULT_SIZES = [100, 500, 2000]
+SHELLS = ["sh", "bash", "zsh"]
+RELEASES = ["1.5.0", "1.7.1", "1.9.0"]
+REPO_ROOT = Path(__file__).resolve().parents[5]
+PHASES = ["get_packages", "order_packages", "get_commands"]
+
+# what main() of every util copy configures for the sh extension
+SH_FORMATS = {
+    "FORMAT_STR_COMMENT_LINE": "# {comment}",
+    "FORMAT_STR_SET_ENV_VAR": 'export {name}="{value}"',
+    "FORMAT_STR_USE_ENV_VAR": "${name}",
+    "FORMAT_STR_INVOKE_SCRIPT":
+        'AMENT_CURRENT_PREFIX="{prefix}" '
+        '_ament_prefix_sh_source_script "{script_path}"',
+    "FORMAT_STR_REMOVE_LEADING_SEPARATOR": "export {name}=${{{name}#:}}",
+    "FORMAT_STR_REMOVE_TRAILING_SEPARATOR": "export {name}=${{{name}%:}}",
+}
+
+
+def release_util(version):
+    """The amd64 copy of the util of a release in this repository."""
+    return (REPO_ROOT / version / "amd64" / "packages" / "autoware-config"
+            / "src" / "_local_setup_util.py")
+
+
+def fresh_util(path):
+    """Load an unused copy of the util, configured like `util.py sh bash`."""
+    util = load_util(path, "util_bench")
+    for name, value in SH_FORMATS.items():
+        setattr(util, name, value)
+    return util
+
+
+def time_phases(util_path, prefix, repeat):
+    """Time the phases in-process, each run with a fresh module state."""
+    def with_packages():
+        util = fresh_util(util_path)
+        return util, util.get_packages(prefix)
+
+    def with_ordered_packages():
+        util, packages = with_packages()
+        return util, util.order_packages(packages)
+
+    def get_all_commands(setup):
+        util, packages = setup
+        for name in packages:
+            util.get_commands(name, str(prefix), "sh", "bash")
+
+    return {
+        "get_packages": best_of(
+            lambda util: util.get_packages(prefix), repeat,
+            setup=lambda: fresh_util(util_path)),
+        "order_packages": best_of(
+            lambda setup: setup[0].order_packages(setup[1]), repeat,
+            setup=with_packages),
+        "get_commands": best_of(
+            get_all_commands, repeat, setup=with_ordered_packages),
+    }
+
+
+def source_setup(prefix, shell, home):
+    """Source local_setup.<shell> of the prefix in a clean environment."""
+    env = {
+        "PATH": os.environ.get("PATH", "/usr/bin:/bin"),
+        "HOME": home,
+        "AMENT_PYTHON_EXECUTABLE": sys.executable,
+        "AUTOWARE_SETUP_NO_CACHE": "1",
+    }
+    if shell == "sh":
+        # a plain shell script can't determine its own location
+        env["AMENT_CURRENT_PREFIX"] = str(prefix)
+    subprocess.run(
+        [shell, "-c", f'. "{prefix}/local_setup.{shell}"'],
+        env=env, stdout=subprocess.DEVNULL, check=True)
+
+
+def install_util(util_path, prefix):
+    """Copy the util, its helpers and the local_setup scripts into the prefix."""
+    src = Path(util_path).parent
+    copy_util(util_path, prefix)
+    for shell in SHELLS:
+        script = src / f"local_setup.{shell}"
+        if script.exists():
+            shutil.copy(script, prefix / script.name)
+
+
+def parse_util(value):
+    """Parse `[LABEL=]PATH`, the label defaults to the release directory."""
+    label, sep, path = value.partition("=")
+    if not sep:
+        path = value
+        label = Path(path).resolve().parents[4].name
+    if not Path(path).is_file():
+        raise argparse.ArgumentTypeError(f"{path} not found")
+    return label, Path(path)
+
+
+def print_table(results, baseline):
+    columns = PHASES + [f"{shell} source" for shell in SHELLS]
+    print(f"{'packages':>9}  {'util':<10}"
+          + "".join(f"{c:>16}" for c in columns))
+    previous = {
+        (r["util"], r["packages"]): r for r in (baseline or {}).get("results", [])}
+    for result in results:
+        old = previous.get((result["util"], result["packages"]))
+        cells = []
+        for column in columns:
+            if column in PHASES:
+                value = result["ms"][column]
+                old_value = old and old["ms"].get(column)
+            else:
+                shell = column.split()[0]
+                value = result["source_ms"].get(shell)
+                old_value = old and old["source_ms"].get(shell)
+            if value is None:
+                cells.append("-")
+            elif old_value:
+                cells.append(f"{value:.1f} ({value / old_value - 1:+.0%})")
+            else:
+                cells.append(f"{value:.1f}")
+        print(f"{result['packages']:>9}  {result['util']:<10}"
+              + "".join(f"{c:>16}" for c in cells))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the setup generator on synthetic prefixes")
+    parser.add_argument(
+        "--sizes", type=int, nargs="+", default=DEFAULT_SIZES,
+        help="Synthetic package counts (default: 100 500 2000)")
+    parser.add_argument(
+        "--fanout", type=int, default=6,
+        help="Maximum runtime dependencies per package (default: 6)")
+    parser.add_argument(
+        "--dsv-depth", type=int, default=2,
+        help="Chained dsv files per package, 2 like ament_cmake (default: 2)")
+    parser.add_argument(
+        "--hook-type", choices=HOOK_TYPES, default="dsv",
+        help="Environment hooks as dsv files, shell scripts or alternating "
+             "(default: dsv)")
+    parser.add_argument(
+        "--shells", nargs="*", choices=SHELLS, default=SHELLS,
+        help="Shells to source the setup with, missing ones are skipped "
+             "(default: sh bash zsh)")
+    parser.add_argument(
+        "--repeat", type=int, default=3,
+        help="Runs per measurement, the fastest is reported (default: 3)")
+    parser.add_argument(
+        "--util", dest="utils", type=parse_util, action="append",
+        metavar="[LABEL=]PATH",
+        help="_local_setup_util.py to benchmark, repeatable (default: this "
+             "tree's copy)")
+    parser.add_argument(
+        "--releases", action="store_true",
+        help=f"Benchmark the amd64 copies of {', '.join(RELEASES)}")
+    parser.add_argument(
+        "--output", help="Write the results to this JSON file")
+    parser.add_argument(
+        "--compare", metavar="JSON",
+        help="Show the change relative to the results of a previous run")
+    args = parser.parse_args()
+
+    utils = args.utils or []
+    if args.releases:
+        utils += [(version, release_util(version)) for version in RELEASES]
+    if not utils:
+        utils = [("current", DEFAULT_UTIL)]
+    shells = [shell for shell in args.shells if shutil.which(shell)]
+    for shell in sorted(set(args.shells) - set(shells)):
+        print(f"Warning: {shell} not found, skipping", file=sys.stderr)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+
+    results = []
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = Path(tmp) / "prefix"
+        for size in args.sizes:
+            make_prefix(prefix, size, args.fanout, dsv_depth=args.dsv_depth,
+                        hook_type=args.hook_type)
+            for label, util_path in utils:
+                install_util(util_path, prefix)
+                phases = time_phases(util_path, prefix, args.repeat)
+                results.append({
+                    "util": label,
+                    "util_path": str(util_path),
+                    "packages": size,
+                    "ms": {name: t * 1e3 for name, t in phases.items()},
+                    "source_ms": {
+                        shell: best_of(
+                            lambda: source_setup(prefix, shell, tmp),
+                            args.repeat) * 1e3
+                        for shell in shells},
+                })
+
+    print(f"fanout {args.fanout}, dsv depth {args.dsv_depth}, "
+          f"{args.hook_type} hooks, times in ms")
+    print_table(results, baseline)
+
+    if args.output:
+        report = {
+            "date": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "host": platform.node(),
+            "python": platform.python_version(),
+            "parameters": {
+                "fanout": args.fanout,
+                "dsv_depth": args.dsv_depth,
+                "hook_type": args.hook_type,
+                "repeat": args.repeat,
+            },
+            "results": results,
+        }
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+            f.write("\n")
+
+
+if __name__ == "__main__":
+    main()
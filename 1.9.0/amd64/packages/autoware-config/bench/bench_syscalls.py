@@ -0,0 +1,133 @@
+#!/usr/bin/env python3
+"""Count the file system calls _local_setup_util.py makes on a synthetic prefix.
+
+Each util is copied into a freshly generated prefix (it derives the prefix
+from its own location) and run once with the snapshot cache disabled.
+
+By default the calls are counted in-process by wrapping the os/io functions
+that issue stat, open and directory listing syscalls. With --strace the util
+runs under `strace -f -c` instead, which also includes interpreter startup.
+
+Examples:
+  ./bench_syscalls.py
+  ./bench_syscalls.py --baseline \\
+      ../../../../../1.7.1/amd64/packages/autoware-config/src/_local_setup_util.py
+"""
+
+import argparse
+import builtins
+import collections
+import contextlib
+import io
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+from benchlib import DEFAULT_UTIL, copy_util, load_util, make_prefix
+
+COUNTED = [
+    (os, "stat"), (os, "lstat"), (os, "access"), (os, "open"),
+    (os, "scandir"), (os, "listdir"), (io, "open"), (builtins, "open"),
+]
+
+
+@contextlib.contextmanager
+def count_calls(counts):
+    """Wrap the COUNTED functions so each call increments `counts`."""
+    originals = [(mod, name, getattr(mod, name)) for mod, name in COUNTED]
+
+    def wrap(label, func):
+        def wrapper(*args, **kwargs):
+            counts[label] += 1
+            return func(*args, **kwargs)
+        return wrapper
+
+    for mod, name, func in originals:
+        label = "open" if name == "open" else name
+        setattr(mod, name, wrap(label, func))
+    try:
+        yield counts
+    finally:
+        for mod, name, func in originals:
+            setattr(mod, name, func)
+
+
+def run_in_process(util_path, argv):
+    """Run the util's main() and return the counted calls."""
+    util = load_util(util_path, "util_" + Path(util_path).stem)
+    counts = collections.Counter()
+    with open(os.devnull, "w") as devnull, \
+            contextlib.redirect_stdout(devnull), count_calls(counts):
+        util.main(argv)
+    return counts
+
+
+def run_strace(util_path, argv):
+    """Run the util under strace and return the syscall summary."""
+    with tempfile.NamedTemporaryFile("r", suffix=".strace") as out:
+        subprocess.run(
+            ["strace", "-f", "-c", "-o", out.name, sys.executable,
+             str(util_path), *argv],
+            check=True, stdout=subprocess.DEVNULL)
+        counts = collections.Counter()
+        for line in out.read().splitlines():
+            fields = line.split()
+            # "% time seconds usecs/call calls [errors] syscall"
+            if len(fields) >= 5 and fields[3].isdigit() and fields[-1] != "total":
+                counts[fields[-1]] = int(fields[3])
+        return counts
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Compare file system calls of _local_setup_util.py copies")
+    parser.add_argument(
+        "--packages", type=int, default=450,
+        help="Synthetic package count (default: 450)")
+    parser.add_argument(
+        "--util", default=str(DEFAULT_UTIL),
+        help="_local_setup_util.py to measure (default: this tree's copy)")
+    parser.add_argument(
+        "--baseline", help="Another _local_setup_util.py to compare against")
+    parser.add_argument(
+        "--strace", action="store_true",
+        help="Count real syscalls with strace instead of in-process wrappers")
+    parser.add_argument(
+        "--shell", nargs="+", default=["sh", "bash"],
+        help="Extensions passed to the util (default: sh bash)")
+    args = parser.parse_args()
+
+    if args.strace and not shutil.which("strace"):
+        parser.error("strace is not installed")
+    os.environ["AUTOWARE_SETUP_NO_CACHE"] = "1"
+
+    utils = [("current", args.util)]
+    if args.baseline:
+        utils.append(("baseline", args.baseline))
+
+    results = {}
+    with tempfile.TemporaryDirectory() as tmp:
+        prefix = Path(tmp) / "prefix"
+        make_prefix(prefix, args.packages)
+        for label, path in utils:
+            # the helpers module is shared, copy it right before the run
+            target = prefix / f"_{label}_setup_util.py"
+            copy_util(path, prefix, target.name)
+            run = run_strace if args.strace else run_in_process
+            results[label] = run(target, args.shell)
+
+    names = sorted(set().union(*results.values()))
+    print(f"{args.packages} packages, `{' '.join(args.shell)}`")
+    print(f"{'call':<16}" + "".join(f"{label:>10}" for label, _ in utils))
+    for name in names:
+        print(f"{name:<16}" + "".join(
+            f"{results[label][name]:>10}" for label, _ in utils))
+    print(f"{'total':<16}" + "".join(
+        f"{sum(results[label].values()):>10}" for label, _ in utils))
+
+
+if __name__ == "__main__":
+    main()
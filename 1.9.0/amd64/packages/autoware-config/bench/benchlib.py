@@ -0,0 +1,179 @@
+"""Shared helpers for the _local_setup_util.py benchmarks."""
+
+import importlib.util
+import os
+import random
+import shutil
+import sys
+import time
+from pathlib import Path
+
+DEFAULT_UTIL = Path(__file__).resolve().parent.parent / "src" / "_local_setup_util.py"
+# the module the util imports from its own directory
+HELPERS_MODULE = "_local_setup_helpers"
+
+
+def load_util(path=DEFAULT_UTIL, name="_local_setup_util"):
+    """Import a copy of _local_setup_util.py as a module.
+
+    Each call returns a fresh module so that the global env_state of one run
+    does not leak into the next. The helpers module imported for a previous
+    copy is dropped, so that this one imports the module next to it.
+    """
+    sys.modules.pop(HELPERS_MODULE, None)
+    directory = os.path.dirname(os.path.abspath(path))
+    if directory in sys.path:
+        sys.path.remove(directory)
+    sys.path.insert(0, directory)
+    spec = importlib.util.spec_from_file_location(name, str(path))
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def copy_util(util_path, directory, name="_local_setup_util.py"):
+    """Copy a util and the helpers module next to it into `directory`.
+
+    Utils of releases without the helpers module remove a stale copy.
+    """
+    util_path = Path(util_path)
+    directory = Path(directory)
+    shutil.copy(util_path, directory / name)
+    helpers = util_path.parent / f"{HELPERS_MODULE}.py"
+    if helpers.exists():
+        shutil.copy(helpers, directory / helpers.name)
+    else:
+        (directory / helpers.name).unlink(missing_ok=True)
+
+
+def package_names(count):
+    """Deterministic package names which do not sort in creation order."""
+    rnd = random.Random(count)
+    names = [f"pkg_{i:06d}" for i in range(count)]
+    rnd.shuffle(names)
+    return names
+
+
+def make_dependency_graph(count, fanout=6, seed=0):
+    """Build a random acyclic runtime-dependency graph.
+
+    Every package depends on up to `fanout` packages created before it, which
+    mirrors how a ROS workspace layers drivers, libraries and launch packages.
+    """
+    rnd = random.Random(seed)
+    names = package_names(count)
+    graph = {}
+    for i, name in enumerate(names):
+        graph[name] = set(rnd.sample(names[:i], min(i, rnd.randint(0, fanout))))
+    return graph
+
+
+HOOK_TYPES = ("dsv", "sh", "mixed")
+
+
+def make_prefix(root, count, fanout=6, seed=0, dsv_depth=2, hook_type="dsv"):
+    """Create a synthetic ament install prefix with `count` packages.
+
+    The layout follows what ament_cmake and colcon install: a resource index
+    marker and run dependencies per package, a package.dsv listing the local
+    setup hooks and environment hooks which prepend to AMENT_PREFIX_PATH,
+    PATH, LD_LIBRARY_PATH and PYTHONPATH. Every 17th package ships plain shell
+    hooks without a package.dsv, like packages built by non-ament tools.
+
+    `dsv_depth` is the length of the chain of dsv files from package.dsv to
+    the one listing the environment hooks (ament_cmake installs two). With
+    `hook_type` "dsv" the environment hooks are described by dsv files which
+    the util evaluates, with "sh" they are shell scripts which have to be
+    sourced, "mixed" alternates between both per package.
+    Returns the dependency graph that was written.
+    """
+    if dsv_depth < 1:
+        raise ValueError("dsv_depth must be at least 1")
+    if hook_type not in HOOK_TYPES:
+        raise ValueError(f"hook_type must be one of {', '.join(HOOK_TYPES)}")
+    root = Path(root)
+    if root.exists():
+        shutil.rmtree(root)
+    index = root / "share" / "ament_index" / "resource_index"
+    (index / "packages").mkdir(parents=True)
+    (index / "package_run_dependencies").mkdir()
+    for d in ("bin", "lib", "lib/python3.10/site-packages"):
+        (root / d).mkdir(parents=True)
+
+    graph = make_dependency_graph(count, fanout, seed)
+    for i, (name, deps) in enumerate(graph.items()):
+        (index / "packages" / name).touch()
+        # ament also records dependencies outside of this prefix
+        run_deps = sorted(deps) + ["rclcpp", "rosidl_default_runtime"]
+        (index / "package_run_dependencies" / name).write_text(";".join(run_deps))
+
+        share = root / "share" / name
+        (share / "environment").mkdir(parents=True)
+        if i % 17 == 0:
+            for ext in ("sh", "bash", "zsh"):
+                (share / f"local_setup.{ext}").write_text(
+                    f"export {name.upper()}_HOME=\"$AMENT_CURRENT_PREFIX\"\n")
+            continue
+
+        # package.dsv -> local_setup.dsv -> local_setup_2.dsv -> ...
+        dsv_names = ["package"] + ["local_setup"] + [
+            f"local_setup_{depth}" for depth in range(2, dsv_depth)]
+        dsv_names = dsv_names[:dsv_depth]
+        for parent, child in zip(dsv_names, dsv_names[1:]):
+            _write_hooks(share, name, [child], ("bash", "dsv", "sh", "zsh"),
+                         f"{parent}.dsv")
+        use_dsv = hook_type == "dsv" or (hook_type == "mixed" and i % 2 == 0)
+        hooks = {
+            "ament_prefix_path": "prepend-non-duplicate;AMENT_PREFIX_PATH;",
+            "path": "prepend-non-duplicate-if-exists;PATH;bin",
+            "library_path": "prepend-non-duplicate;LD_LIBRARY_PATH;lib",
+        }
+        if i % 3 == 0:
+            hooks["pythonpath"] = \
+                "prepend-non-duplicate;PYTHONPATH;lib/python3.10/site-packages"
+        lines = []
+        for hook, dsv in hooks.items():
+            if use_dsv:
+                (share / "environment" / f"{hook}.dsv").write_text(dsv + "\n")
+                (share / "environment" / f"{hook}.sh").write_text("# generated\n")
+                lines += [f"source;share/{name}/environment/{hook}.{ext}"
+                          for ext in ("dsv", "sh")]
+            else:
+                # what ament_cmake_core generates for environment hooks
+                _, variable, subdirectory = dsv.split(";")
+                value = "$AMENT_CURRENT_PREFIX"
+                if subdirectory:
+                    value += "/" + subdirectory
+                (share / "environment" / f"{hook}.sh").write_text(
+                    f"ament_prepend_unique_value {variable} \"{value}\"\n")
+                lines.append(f"source;share/{name}/environment/{hook}.sh")
+        (share / f"{dsv_names[-1]}.dsv").write_text("\n".join(lines) + "\n")
+    return graph
+
+
+def _write_hooks(share, name, basenames, extensions, dsv_name):
+    """Write a DSV file sourcing `basenames` and the shell hooks it names."""
+    lines = []
+    for basename in basenames:
+        for ext in extensions:
+            lines.append(f"source;share/{name}/{basename}.{ext}")
+            if ext != "dsv":
+                (share / f"{basename}.{ext}").write_text("# generated\n")
+    (share / dsv_name).write_text("\n".join(lines) + "\n")
+
+
+def best_of(func, repeat=3, setup=None):
+    """Return the fastest wall-clock time of `repeat` calls in seconds.
+
+    If given, `setup` is called untimed before every run and its result is
+    passed to `func`.
+    """
+    best = None
+    for _ in range(repeat):
+        args = (setup(),) if setup else ()
+        start = time.perf_counter()
+        func(*args)
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
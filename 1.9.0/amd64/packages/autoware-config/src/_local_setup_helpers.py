@@ -0,0 +1,522 @@
+# Licensed under the Apache License, Version 2.0
+
+# The parts of _local_setup_util.py which a cache hit doesn't need: walking
+# the prefix, the snapshot cache, --packages-up-to, the json extension and the
+# profile report. Unlike the util, which runs as a script and is compiled on
+# every invocation, this module is imported and therefore byte-compiled. It
+# must not import the util, whose state is passed in where needed.
+
+# json, re and tempfile are imported where needed so that a cache hit only
+# pays for importing json
+from collections import OrderedDict
+import os
+import sys
+
+
+# the snapshot cache lives outside the (read-only) install prefix
+CACHE_DIR_ENV_VAR = 'AUTOWARE_SETUP_CACHE_DIR'
+# only packaged prefixes are cached unless CACHE_DIR_ENV_VAR is set, since the
+# invalidation relies on dpkg touching the resource index, see get_prefix_stamp()
+CACHE_DEFAULT_PREFIX_ROOT = '/opt/'
+CACHE_DISABLE_ENV_VAR = 'AUTOWARE_SETUP_NO_CACHE'
+CACHE_FORMAT_VERSION = 1
+# number of distinct initial environments remembered per shell
+CACHE_MAX_VARIANTS = 8
+
+# the events recorded by the util itself, others are written by the shell
+PROFILE_UTIL_CATEGORIES = ('phase', 'package')
+
+
+def resolve_commands(lines):
+    """
+    Apply the intermediate commands of the json extension to the environment.
+
+    :param list lines: The commands generated for the json extension
+    :returns: A mapping with the resulting values of all variables which have
+      been modified and the scripts which still need to be sourced, in order,
+      on top of that environment
+    :rtype: dict
+    """
+    environ = dict(os.environ)
+    modified = OrderedDict()
+    scripts = []
+    for line in lines:
+        command, *arguments = line.split('\t', 2)
+        if command == 'set':
+            name, value = arguments
+            parts = value.split('\0')
+            # every odd part is the name of a referenced variable
+            for i in range(1, len(parts), 2):
+                parts[i] = environ.get(parts[i], '')
+            environ[name] = ''.join(parts)
+        elif command in ('lstrip', 'rstrip'):
+            name, = arguments
+            value = environ.get(name, '')
+            if command == 'lstrip' and value.startswith(os.pathsep):
+                value = value[len(os.pathsep):]
+            elif command == 'rstrip' and value.endswith(os.pathsep):
+                value = value[:-len(os.pathsep)]
+            environ[name] = value
+        elif command == 'source':
+            prefix, script_path = arguments
+            scripts.append({'prefix': prefix, 'path': script_path})
+            continue
+        else:
+            continue
+        modified[name] = environ[name]
+    return {'environment': modified, 'scripts': scripts}
+
+
+def get_package_closure(packages, pkg_names):
+    """
+    Reduce the packages to the given ones and their runtime dependencies.
+
+    :param dict packages: A mapping from package name to the set of runtime
+      dependencies
+    :param list pkg_names: The names of the packages to start from
+    :returns: The subset of the mapping reachable from the given packages
+    :rtype: dict
+    """
+    unknown = sorted(set(pkg_names) - set(packages))
+    if unknown:
+        raise RuntimeError(
+            'Unknown package(s) in prefix: ' + ', '.join(unknown))
+    closure = {}
+    to_visit = list(pkg_names)
+    while to_visit:
+        pkg_name = to_visit.pop()
+        if pkg_name in closure:
+            continue
+        closure[pkg_name] = packages[pkg_name]
+        to_visit += packages[pkg_name]
+    return closure
+
+
+def get_cache_path(prefix):
+    """
+    Get the snapshot cache file of a prefix.
+
+    Without an explicit cache directory only prefixes under
+    CACHE_DEFAULT_PREFIX_ROOT are cached, e.g. a colcon workspace isn't
+    installed by dpkg and changes without touching its resource index.
+
+    :param str prefix: The install prefix path of all packages
+    :returns: The path of the cache file or None if caching is disabled
+    :rtype: str
+    """
+    if os.environ.get(CACHE_DISABLE_ENV_VAR):
+        return None
+    cache_dir = os.environ.get(CACHE_DIR_ENV_VAR)
+    if not cache_dir:
+        if not prefix.startswith(CACHE_DEFAULT_PREFIX_ROOT):
+            return None
+        cache_home = os.environ.get('XDG_CACHE_HOME') or \
+            os.path.join(os.path.expanduser('~'), '.cache')
+        cache_dir = os.path.join(cache_home, 'autoware-setup')
+    # escape the prefix into a unique file name without hashing it
+    name = prefix.replace('%', '%25').replace(os.sep, '%2F')
+    return os.path.join(cache_dir, name + '.json')
+
+
+def get_parse_cache_path(cache_path):
+    # the parsed files of a prefix are stored next to its snapshot cache
+    return os.path.splitext(cache_path)[0] + '.files.json'
+
+
+def get_prefix_stamp(prefix, util_path):
+    """
+    Fingerprint the parts of the prefix which change when packages change.
+
+    dpkg unpacks every file of a package through a rename, so installing,
+    upgrading or removing any package touches the mtime of the resource index
+    directories even if only a hook of that package changed.
+
+    :param str prefix: The install prefix path of all packages
+    :param str util_path: The path of the util generating the commands
+    :returns: The modification times of the resource index, the util and
+      this module
+    :rtype: list
+    """
+    resource_index = os.path.join(
+        prefix, 'share', 'ament_index', 'resource_index')
+    stamp = []
+    for path in (
+        os.path.join(resource_index, 'packages'),
+        os.path.join(resource_index, 'package_run_dependencies'),
+        util_path,
+        os.path.abspath(__file__),
+    ):
+        try:
+            st = os.stat(path)
+        except OSError:
+            stamp.append(None)
+            continue
+        stamp.append([st.st_mtime_ns, st.st_size])
+    return stamp
+
+
+def load_cache(cache_path, stamp):
+    """
+    Load the snapshot cache of a prefix.
+
+    :param str cache_path: The path of the cache file
+    :param list stamp: The current fingerprint of the prefix
+    :returns: The cache content, empty if missing, unreadable or stale
+    :rtype: dict
+    """
+    import json
+    try:
+        with open(cache_path, 'r') as h:
+            cache = json.load(h)
+    except (OSError, ValueError):
+        return {}
+    if (
+        not isinstance(cache, dict) or
+        cache.get('version') != CACHE_FORMAT_VERSION or
+        cache.get('stamp') != stamp
+    ):
+        return {}
+    return cache
+
+
+def lookup_cache(cache, cache_key):
+    """
+    Find the cached commands matching the arguments and initial environment.
+
+    :param dict cache: The cache content
+    :param str cache_key: The command line arguments
+    :returns: The cached commands or None
+    :rtype: list
+    """
+    for variant in cache.get('entries', {}).get(cache_key, []):
+        if all(
+            os.environ.get(name) == value
+            for name, value in variant['environ'].items()
+        ):
+            return variant['commands']
+    return None
+
+
+def store_cache(cache_path, cache, prefix, stamp, cache_key, lines, env_reads):
+    """
+    Store the generated commands for the arguments and initial environment.
+
+    Failing to write the cache (e.g. a read-only home) is not an error.
+
+    :param str cache_path: The path of the cache file
+    :param dict cache: The cache content as loaded, possibly empty
+    :param str prefix: The install prefix path of all packages
+    :param list stamp: The fingerprint of the prefix
+    :param str cache_key: The command line arguments
+    :param list lines: The generated commands
+    :param set env_reads: The names of the environment variables which have
+      been read while generating the commands
+    """
+    entries = cache.get('entries', {}) if cache else {}
+    # only the environment variables which have been read influence the
+    # generated commands
+    environ = {name: os.environ.get(name) for name in sorted(env_reads)}
+    variants = [
+        v for v in entries.get(cache_key, []) if v['environ'] != environ]
+    variants.insert(0, {'environ': environ, 'commands': lines})
+    entries[cache_key] = variants[:CACHE_MAX_VARIANTS]
+    cache = {
+        'version': CACHE_FORMAT_VERSION,
+        'prefix': prefix,
+        'stamp': stamp,
+        'entries': entries,
+    }
+    _write_cache_file(cache_path, cache)
+
+
+def _write_cache_file(path, data):
+    # replace the file atomically since other shells may read it concurrently,
+    # failing to write a cache must not fail the setup
+    import json
+    import tempfile
+    cache_dir = os.path.dirname(path)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as h:
+                json.dump(data, h)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+    except OSError:
+        pass
+
+
+class PrefixInventory:
+    """
+    Answer existence checks from directory listings.
+
+    Each directory is listed at most once with a single `os.scandir` call
+    instead of issuing one `stat` per checked path, which matters on network
+    and overlay file systems where every metadata lookup is expensive.
+    """
+
+    def __init__(self):  # noqa: D107
+        self._listings = {}
+
+    def list_dir(self, path):
+        """
+        Get the entries of a directory.
+
+        :param str path: The directory path
+        :returns: A mapping from entry names to `os.DirEntry` instances or
+          None if the path isn't a directory
+        :rtype: dict
+        """
+        path = os.path.normpath(path)
+        if path not in self._listings:
+            try:
+                with os.scandir(path) as it:
+                    self._listings[path] = {e.name: e for e in it}
+            except OSError:
+                self._listings[path] = None
+        return self._listings[path]
+
+    def exists(self, path):
+        """
+        Check if a path exists, following symlinks like `os.path.exists`.
+
+        :param str path: The path to check
+        :rtype: bool
+        """
+        parent, name = os.path.split(os.path.normpath(path))
+        if name in ('', os.curdir, os.pardir):
+            return os.path.exists(path)
+        entries = self.list_dir(parent)
+        if entries is None or name not in entries:
+            return False
+        if entries[name].is_symlink():
+            # only a dangling symlink is listed but doesn't exist
+            return os.path.exists(path)
+        return True
+
+    def stat(self, path):
+        """
+        Get the status of a path, following symlinks like `os.stat`.
+
+        The status is taken from the `os.DirEntry` of the listing, which
+        caches it and on some platforms already got it from the listing.
+
+        :param str path: The path to get the status of
+        :returns: The `os.stat_result` or None if the path doesn't exist
+        """
+        parent, name = os.path.split(os.path.normpath(path))
+        entries = self.list_dir(parent)
+        if entries is None or name not in entries:
+            return None
+        try:
+            return entries[name].stat()
+        except OSError:
+            return None
+
+
+class ParseCache:
+    """
+    Remember the parsed content of files in the prefix across invocations.
+
+    Entries are keyed by path and are only used while the modification time
+    and size of the file are unchanged, so after upgrading a few packages only
+    their files are parsed again. Entries of files not used by an invocation,
+    e.g. one scoped with --packages-up-to, are kept while the files exist.
+    """
+
+    def __init__(self, path, inventory):
+        """
+        Load the entries of a previous invocation.
+
+        :param str path: The path of the cache file
+        :param inventory: The `PrefixInventory` of the util to stat and check
+          the files through
+        """
+        import json
+        self._path = path
+        self._inventory = inventory
+        self._entries = {}
+        self._used = set()
+        self._modified = False
+        try:
+            with open(path, 'r') as h:
+                data = json.load(h)
+        except (OSError, ValueError):
+            return
+        if (
+            isinstance(data, dict) and
+            data.get('version') == CACHE_FORMAT_VERSION
+        ):
+            self._entries = data.get('entries', {})
+
+    def get(self, path, parse):
+        """
+        Get the parsed content of a file.
+
+        :param str path: The path of the file
+        :param parse: The function to parse the file if it isn't cached,
+          called with the path and returning a JSON serializable value
+        :returns: The parsed content
+        """
+        # stat before parsing so that a concurrent change isn't cached
+        st = self._inventory.stat(path)
+        if st is None:
+            return parse(path)
+        stamp = [st.st_mtime_ns, st.st_size]
+        self._used.add(path)
+        entry = self._entries.get(path)
+        if entry is not None and entry['stamp'] == stamp:
+            return entry['value']
+        value = parse(path)
+        self._entries[path] = {'stamp': stamp, 'value': value}
+        self._modified = True
+        return value
+
+    def store(self, complete=False):
+        """
+        Write the entries back to the cache file if any changed.
+
+        Entries of files which no longer exist are dropped. An invocation
+        which processed only some packages checks the other entries only if
+        it wrote anyway, since that requires listing their directories.
+
+        :param bool complete: Whether all packages of the prefix have been
+          processed, so that hardly any entries are unused
+        """
+        if self._modified or complete:
+            # forget files of removed packages
+            entries = {
+                p: e for p, e in self._entries.items()
+                if p in self._used or self._inventory.exists(p)}
+            self._modified |= len(entries) != len(self._entries)
+            self._entries = entries
+        if not self._modified:
+            return
+        _write_cache_file(self._path, {
+            'version': CACHE_FORMAT_VERSION,
+            'entries': self._entries,
+        })
+
+
+def write_profile(path, events):
+    """
+    Append the events recorded by the util to a profile file.
+
+    The file is truncated by local_setup.sh and also receives the events of
+    the shell, one tab separated line per event with start and end in us.
+
+    :param str path: The path of the profile file
+    :param list events: The events as tuples of category, name, start and end
+    """
+    try:
+        with open(path, 'a') as h:
+            for event in events:
+                h.write('\t'.join(str(v) for v in event) + '\n')
+    except OSError as e:
+        print('Failed to write profile: ' + str(e), file=sys.stderr)
+
+
+def _parse_profile_time(value):
+    # the shell writes $EPOCHREALTIME (seconds, locale dependent decimal
+    # separator) if available, otherwise `date +%s%6N` (microseconds)
+    value = value.replace(',', '.')
+    if '.' in value:
+        return round(float(value) * 1000000)
+    return int(value)
+
+
+def read_profile(path):
+    """
+    Read the events recorded in a profile file.
+
+    Malformed lines, e.g. from a `date` without nanosecond support, are
+    skipped.
+
+    :param str path: The path of the profile file
+    :returns: The events as tuples of category, name, start and end in us
+    :rtype: list
+    """
+    events = []
+    with open(path, 'r') as h:
+        for line in h.read().splitlines():
+            try:
+                category, name, start, end = line.split('\t')
+                events.append((
+                    category, name,
+                    _parse_profile_time(start), _parse_profile_time(end)))
+            except ValueError:
+                continue
+    return events
+
+
+def _script_package(script_path):
+    # package scripts are installed under <prefix>/share/<pkg_name>/
+    import re
+    match = re.search(r'/share/([^/]+)/', script_path)
+    return match.group(1) if match else script_path
+
+
+def print_profile_report(path, chrome_trace=None):
+    """
+    Print the phases and the packages of a profile sorted by their cost.
+
+    The cost of a package is the time spent processing its DSV files plus
+    the time spent sourcing its scripts.
+
+    :param str path: The path of the profile file
+    :param str chrome_trace: If given, the path to write the events to in
+      the Chrome trace event format
+    """
+    import json
+    events = read_profile(path)
+    print('Setup profile %s (times in ms)' % path)
+    print()
+    print('%-24s %10s' % ('phase', 'time'))
+    for category, name, start, end in events:
+        if category in ('phase', 'shell'):
+            print('%-24s %10.1f' % (name, (end - start) / 1000))
+
+    dsv_times = {}
+    script_times = {}
+    script_counts = {}
+    for category, name, start, end in events:
+        if category == 'package':
+            dsv_times[name] = dsv_times.get(name, 0) + end - start
+        elif category == 'hook':
+            pkg_name = _script_package(name)
+            script_times[pkg_name] = \
+                script_times.get(pkg_name, 0) + end - start
+            script_counts[pkg_name] = script_counts.get(pkg_name, 0) + 1
+    totals = {
+        name: dsv_times.get(name, 0) + script_times.get(name, 0)
+        for name in set(dsv_times) | set(script_times)}
+    print()
+    print('%10s %10s %10s %8s  %s' % (
+        'total', 'dsv', 'scripts', '#scripts', 'package'))
+    for name in sorted(totals, key=lambda n: (-totals[n], n)):
+        print('%10.1f %10.1f %10.1f %8d  %s' % (
+            totals[name] / 1000, dsv_times.get(name, 0) / 1000,
+            script_times.get(name, 0) / 1000, script_counts.get(name, 0),
+            name))
+
+    if chrome_trace:
+        origin = min((e[2] for e in events), default=0)
+        trace_events = [
+            {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': tid,
+             'args': {'name': thread_name}}
+            for tid, thread_name in ((1, 'python'), (2, 'shell'))]
+        for category, name, start, end in events:
+            trace_events.append({
+                'name': name,
+                'cat': category,
+                'ph': 'X',
+                'ts': start - origin,
+                'dur': end - start,
+                'pid': 1,
+                'tid': 1 if category in PROFILE_UTIL_CATEGORIES else 2,
+            })
+        with open(chrome_trace, 'w') as h:
+            json.dump({'traceEvents': trace_events}, h)
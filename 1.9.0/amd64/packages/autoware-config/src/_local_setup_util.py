@@ -2,11 +2,15 @@
 # Copyright 2019 Open Source Robotics Foundation, Inc.
 # Licensed under the Apache License, Version 2.0
 
+# heapq and the sibling module with everything but the core of generating the
+# commands are imported where needed, see _helpers()
 import argparse
 from collections import OrderedDict
+from contextlib import contextmanager
 import os
 from pathlib import Path
 import sys
+import time
 
 
 FORMAT_STR_COMMENT_LINE = None
@@ -14,6 +18,7 @@ FORMAT_STR_SET_ENV_VAR = None
 FORMAT_STR_USE_ENV_VAR = None
 FORMAT_STR_INVOKE_SCRIPT = None
 FORMAT_STR_REMOVE_TRAILING_SEPARATOR = None
+FORMAT_STR_SET_ENV_VAR_IF_UNSET = None
 
 DSV_TYPE_APPEND_NON_DUPLICATE = 'append-non-duplicate'
 DSV_TYPE_PREPEND_NON_DUPLICATE = 'prepend-non-duplicate'
@@ -22,6 +27,19 @@ DSV_TYPE_SET = 'set'
 DSV_TYPE_SET_IF_UNSET = 'set-if-unset'
 DSV_TYPE_SOURCE = 'source'
 
+# space separated default for --packages-up-to
+PACKAGES_UP_TO_ENV_VAR = 'AUTOWARE_SETUP_PACKAGES_UP_TO'
+
+# the file the util and local_setup.sh append profiling events to
+PROFILE_ENV_VAR = 'AUTOWARE_SETUP_PROFILE'
+
+# whether to ignore the initial environment, see --static
+STATIC_OUTPUT = False
+# whether to emit a single update per variable, see --coalesce
+COALESCE_OUTPUT = False
+# the profiling event file if enabled, see PROFILE_ENV_VAR
+PROFILE_PATH = None
+
 
 def main(argv=sys.argv[1:]):  # noqa: D103
     global FORMAT_STR_COMMENT_LINE
@@ -30,17 +48,59 @@ def main(argv=sys.argv[1:]):  # noqa: D103
     global FORMAT_STR_INVOKE_SCRIPT
     global FORMAT_STR_REMOVE_LEADING_SEPARATOR
     global FORMAT_STR_REMOVE_TRAILING_SEPARATOR
+    global FORMAT_STR_SET_ENV_VAR_IF_UNSET
+    global STATIC_OUTPUT
+    global COALESCE_OUTPUT
+    global PROFILE_PATH
+    global parse_cache
 
     parser = argparse.ArgumentParser(
         description='Output shell commands for the packages in topological '
                     'order')
     parser.add_argument(
-        'primary_extension',
-        help='The file extension of the primary shell')
+        'primary_extension', nargs='?',
+        help='The file extension of the primary shell, or json to output '
+             'the resolved environment and the sh scripts still to be '
+             'sourced')
     parser.add_argument(
         'additional_extension', nargs='?',
         help='The additional file extension to be considered')
+    parser.add_argument(
+        '--static', action='store_true',
+        help='Output commands which don\'t depend on the current environment '
+             'so that they can be stored in a script and sourced later')
+    parser.add_argument(
+        '--coalesce', action='store_true',
+        help='Combine consecutive updates of a path-like variable into a '
+             'single command')
+    parser.add_argument(
+        '--packages-up-to', action='append', metavar='PKG_NAME',
+        help='Only consider this package and its recursive runtime '
+             'dependencies, can be repeated (default: $%s or all packages)' %
+             PACKAGES_UP_TO_ENV_VAR)
+    parser.add_argument(
+        '--profile-report', metavar='FILE',
+        help='Summarize the events recorded in the given $%s file instead '
+             'of outputting commands' % PROFILE_ENV_VAR)
+    parser.add_argument(
+        '--chrome-trace', metavar='FILE',
+        help='Additionally write the events of --profile-report in the '
+             'Chrome trace event format')
     args = parser.parse_args(argv)
+    if args.profile_report:
+        _helpers().print_profile_report(
+            args.profile_report, args.chrome_trace)
+        return
+    if args.primary_extension is None:
+        parser.error('the following arguments are required: '
+                     'primary_extension')
+    if args.static and args.primary_extension != 'sh':
+        parser.error('--static is only supported for the sh extension')
+    STATIC_OUTPUT = args.static
+    COALESCE_OUTPUT = args.coalesce
+    if args.primary_extension != 'bat':
+        PROFILE_PATH = os.environ.get(PROFILE_ENV_VAR) or None
+    util_start = _now_us()
 
     if args.primary_extension == 'sh':
         FORMAT_STR_COMMENT_LINE = '# {comment}'
@@ -50,6 +110,8 @@ def main(argv=sys.argv[1:]):  # noqa: D103
             '_ament_prefix_sh_source_script "{script_path}"'
         FORMAT_STR_REMOVE_LEADING_SEPARATOR = 'export {name}=${{{name}#:}}'
         FORMAT_STR_REMOVE_TRAILING_SEPARATOR = 'export {name}=${{{name}%:}}'
+        FORMAT_STR_SET_ENV_VAR_IF_UNSET = \
+            '[ -n "${name}" ] || export {name}="{value}"'
     elif args.primary_extension == 'bat':
         FORMAT_STR_COMMENT_LINE = ':: {comment}'
         FORMAT_STR_SET_ENV_VAR = 'set "{name}={value}"'
@@ -61,26 +123,167 @@ def main(argv=sys.argv[1:]):  # noqa: D103
             'call:_ament_prefix_bat_strip_leading_semicolon "{name}"'
         FORMAT_STR_REMOVE_TRAILING_SEPARATOR = \
             'call:_ament_prefix_bat_strip_trailing_semicolon "{name}"'
+    elif args.primary_extension == 'json':
+        # intermediate commands which are resolved by resolve_commands(),
+        # a variable reference is delimited by NUL which can't occur in values
+        FORMAT_STR_COMMENT_LINE = '#\t{comment}'
+        FORMAT_STR_SET_ENV_VAR = 'set\t{name}\t{value}'
+        FORMAT_STR_USE_ENV_VAR = '\0{name}\0'
+        FORMAT_STR_INVOKE_SCRIPT = 'source\t{prefix}\t{script_path}'
+        FORMAT_STR_REMOVE_LEADING_SEPARATOR = 'lstrip\t{name}'
+        FORMAT_STR_REMOVE_TRAILING_SEPARATOR = 'rstrip\t{name}'
     else:
         assert False, 'Unknown primary extension: ' + args.primary_extension
-
-    packages = get_packages(Path(__file__).parent)
-
-    ordered_packages = order_packages(packages)
-    for pkg_name in ordered_packages:
-        if _include_comments():
-            print(
-                FORMAT_STR_COMMENT_LINE.format_map(
-                    {'comment': 'Package: ' + pkg_name}))
-        prefix = os.path.abspath(os.path.dirname(__file__))
-        for line in get_commands(
-            pkg_name, prefix, args.primary_extension,
-            args.additional_extension
-        ):
+    if PROFILE_PATH and args.primary_extension == 'sh':
+        # defined by local_setup.sh, records the time spent in each script
+        FORMAT_STR_INVOKE_SCRIPT = 'AMENT_CURRENT_PREFIX="{prefix}" ' \
+            '_autoware_profile_source_script "{script_path}"'
+    # the json output lists the sh scripts
+    shell_extension = 'sh' if args.primary_extension == 'json' \
+        else args.primary_extension
+
+    prefix = os.path.abspath(os.path.dirname(__file__))
+    # a profile has to measure the actual work
+    helpers = _helpers() if not STATIC_OUTPUT and not PROFILE_PATH else None
+    cache_path = helpers.get_cache_path(prefix) if helpers else None
+    cache_key = ' '.join(argv)
+    # stat the prefix before walking it so that a concurrent change is
+    # detected by the next invocation rather than cached as current
+    stamp = helpers.get_prefix_stamp(prefix, os.path.abspath(__file__)) \
+        if cache_path else None
+    cache = helpers.load_cache(cache_path, stamp) if cache_path else None
+    lines = helpers.lookup_cache(cache, cache_key) if cache else None
+    if lines is None:
+        if cache_path:
+            # reuse what is still current after a partial upgrade
+            parse_cache = helpers.ParseCache(
+                helpers.get_parse_cache_path(cache_path), _inventory())
+        packages_up_to = args.packages_up_to
+        if packages_up_to is None and _getenv(PACKAGES_UP_TO_ENV_VAR):
+            packages_up_to = _getenv(PACKAGES_UP_TO_ENV_VAR).split()
+        lines = generate_commands(
+            prefix, shell_extension, args.additional_extension,
+            packages_up_to=packages_up_to)
+        if cache_path:
+            helpers.store_cache(
+                cache_path, cache, prefix, stamp, cache_key, lines, env_reads)
+            parse_cache.store(complete=packages_up_to is None)
+
+    if args.primary_extension == 'json':
+        import json
+        print(json.dumps(_helpers().resolve_commands(lines), indent=2))
+    else:
+        for line in lines:
             print(line)
 
-    for line in _remove_ending_separators():
-        print(line)
+    if PROFILE_PATH:
+        profile_events.append(('phase', 'util', util_start, _now_us()))
+        _helpers().write_profile(PROFILE_PATH, profile_events)
+
+
+def _helpers():
+    """
+    Import the module with the code which isn't needed on every invocation.
+
+    This script is compiled every time it runs, while the module is
+    byte-compiled once, so the less code lives here the faster a setup is.
+
+    :returns: The `_local_setup_helpers` module next to this script
+    """
+    directory = os.path.dirname(os.path.abspath(__file__))
+    if directory not in sys.path:
+        sys.path.insert(0, directory)
+    import _local_setup_helpers
+    return _local_setup_helpers
+
+
+def generate_commands(
+    prefix, primary_extension, additional_extension, packages_up_to=None
+):
+    """
+    Generate the shell commands for all packages in the prefix.
+
+    :param str prefix: The install prefix path of all packages
+    :param str primary_extension: The file extension of the primary shell
+    :param str additional_extension: The additional file extension to be
+      considered
+    :param list packages_up_to: If given, only these packages and their
+      recursive runtime dependencies are considered
+    :returns: The shell commands in topological order of the packages
+    :rtype: list
+    """
+    lines = []
+    packages = get_packages(Path(prefix))
+    if packages_up_to is not None:
+        with _profile('phase', 'closure'):
+            packages = _helpers().get_package_closure(
+                packages, packages_up_to)
+
+    with _profile('phase', 'ordering'):
+        ordered_packages = order_packages(packages)
+    with _profile('phase', 'dsv'):
+        for pkg_name in ordered_packages:
+            if _include_comments():
+                lines.append(
+                    FORMAT_STR_COMMENT_LINE.format_map(
+                        {'comment': 'Package: ' + pkg_name}))
+            with _profile('package', pkg_name):
+                lines += get_commands(
+                    pkg_name, prefix, primary_extension,
+                    additional_extension)
+
+    lines += _flush_pending_values()
+    lines += _remove_ending_separators()
+    return lines
+
+
+# the events recorded while profiling, see _profile()
+profile_events = []
+
+
+def _now_us():
+    return time.time_ns() // 1000
+
+
+@contextmanager
+def _profile(category, name):
+    """
+    Record the duration of the enclosed block if profiling is enabled.
+
+    :param str category: The kind of the event, either `phase` or `package`
+    :param str name: The name of the phase or package
+    """
+    if not PROFILE_PATH:
+        yield
+        return
+    start = _now_us()
+    try:
+        yield
+    finally:
+        profile_events.append((category, name, start, _now_us()))
+
+
+# the listings of the directories checked in the prefix, see _inventory()
+prefix_inventory = None
+# the parsed files remembered across invocations while caching, see
+# _local_setup_helpers.ParseCache
+parse_cache = None
+
+
+def _inventory():
+    # the existence checks are answered by the PrefixInventory of the
+    # sibling module, which is only imported once the prefix is walked
+    global prefix_inventory
+    if prefix_inventory is None:
+        prefix_inventory = _helpers().PrefixInventory()
+    return prefix_inventory
+
+
+def _parse_file(path, parse):
+    # parse the file or get its content from a previous invocation
+    if parse_cache is None:
+        return parse(path)
+    return parse_cache.get(path, parse)
 
 
 def get_packages(prefix_path):
@@ -96,16 +299,20 @@ def get_packages(prefix_path):
     # since importing ament_index_python isn't feasible here the following
     # constant must match ament_index_python.constants.RESOURCE_INDEX_SUBFOLDER
     subdirectory = 'share/ament_index/resource_index/packages'
+    with _profile('phase', 'scan'):
+        entries = _inventory().list_dir(str(prefix_path / subdirectory))
     # return if workspace is empty
-    if not (prefix_path / subdirectory).is_dir():
+    if entries is None:
         return packages
     # find all files in the subdirectory
-    for p in (prefix_path / subdirectory).iterdir():
-        if not p.is_file():
-            continue
-        if p.name.startswith('.'):
-            continue
-        add_package_runtime_dependencies(p, packages)
+    with _profile('phase', 'dependencies'):
+        for name, entry in entries.items():
+            if not entry.is_file():
+                continue
+            if name.startswith('.'):
+                continue
+            add_package_runtime_dependencies(
+                prefix_path / subdirectory / name, packages)
 
     # remove unknown dependencies
     pkg_names = set(packages.keys())
@@ -125,8 +332,9 @@ def add_package_runtime_dependencies(path, packages):
     """
     dependencies = set()
     marker_file = path.parents[1] / 'package_run_dependencies' / path.name
-    if marker_file.exists():
-        content = marker_file.read_text()
+    if _inventory().exists(str(marker_file)):
+        content = _parse_file(
+            str(marker_file), lambda p: Path(p).read_text())
         dependencies = set(content.split(';') if content else [])
     packages[marker_file.name] = dependencies
 
@@ -135,29 +343,45 @@ def order_packages(packages):
     """
     Order packages topologically.
 
+    Uses Kahn's algorithm with a heap so that among all packages whose
+    dependencies are satisfied the alphabetically first one is picked, which
+    yields the same order as repeatedly scanning for it.
+
     :param dict packages: A mapping from package name to the set of runtime
       dependencies
     :returns: The package names
     :rtype: list
     """
+    import heapq
+    # count the unsatisfied dependencies and invert the dependency graph
+    remaining = {}
+    dependents = {name: [] for name in packages}
+    for name, dependencies in packages.items():
+        remaining[name] = len(dependencies)
+        for dependency in dependencies:
+            dependents[dependency].append(name)
+
     # select packages with no dependencies in alphabetical order
-    to_be_ordered = list(packages.keys())
+    ready = [name for name, count in remaining.items() if not count]
+    heapq.heapify(ready)
     ordered = []
-    while to_be_ordered:
-        pkg_names_without_deps = [
-            name for name in to_be_ordered if not packages[name]]
-        if not pkg_names_without_deps:
-            reduce_cycle_set(packages)
-            raise RuntimeError(
-                'Circular dependency between: ' + ', '.join(sorted(packages)))
-        pkg_names_without_deps.sort()
-        pkg_name = pkg_names_without_deps[0]
-        to_be_ordered.remove(pkg_name)
+    while ready:
+        pkg_name = heapq.heappop(ready)
         ordered.append(pkg_name)
         # remove item from dependency lists
-        for k in list(packages.keys()):
-            if pkg_name in packages[k]:
-                packages[k].remove(pkg_name)
+        for dependent in dependents[pkg_name]:
+            remaining[dependent] -= 1
+            if not remaining[dependent]:
+                heapq.heappush(ready, dependent)
+
+    if len(ordered) < len(packages):
+        done = set(ordered)
+        unordered = {
+            name: dependencies - done
+            for name, dependencies in packages.items() if name not in done}
+        reduce_cycle_set(unordered)
+        raise RuntimeError(
+            'Circular dependency between: ' + ', '.join(sorted(unordered)))
     return ordered
 
 
@@ -189,13 +413,13 @@ def reduce_cycle_set(packages):
 def _include_comments():
     # skipping comment lines when AMENT_TRACE_SETUP_FILES is not set speeds up
     # the processing especially on Windows
-    return bool(os.environ.get('AMENT_TRACE_SETUP_FILES'))
+    return bool(_getenv('AMENT_TRACE_SETUP_FILES'))
 
 
 def get_commands(pkg_name, prefix, primary_extension, additional_extension):
     commands = []
     package_dsv_path = os.path.join(prefix, 'share', pkg_name, 'package.dsv')
-    if os.path.exists(package_dsv_path):
+    if _inventory().exists(package_dsv_path):
         commands += process_dsv_file(
             package_dsv_path, prefix, primary_extension, additional_extension)
     else:
@@ -204,11 +428,8 @@ def get_commands(pkg_name, prefix, primary_extension, additional_extension):
         ) + [primary_extension]:
             package_ext_path = os.path.join(
                 prefix, 'share', pkg_name, 'local_setup.' + ext)
-            if os.path.exists(package_ext_path):
-                commands += [
-                    FORMAT_STR_INVOKE_SCRIPT.format_map({
-                        'prefix': prefix,
-                        'script_path': package_ext_path})]
+            if _inventory().exists(package_ext_path):
+                commands += _invoke_script(prefix, package_ext_path)
                 break
 
     return commands
@@ -221,21 +442,10 @@ def process_dsv_file(
     if _include_comments():
         commands.append(
             FORMAT_STR_COMMENT_LINE.format_map({'comment': dsv_path}))
-    with open(dsv_path, 'r') as h:
-        content = h.read()
-    lines = content.splitlines()
+    lines = _parse_file(dsv_path, _parse_dsv_file)
 
     basenames = OrderedDict()
-    for i, line in enumerate(lines):
-        # skip over empty or whitespace-only lines
-        if not line.strip():
-            continue
-        try:
-            type_, remainder = line.split(';', 1)
-        except ValueError:
-            raise RuntimeError(
-                "Line %d in '%s' doesn't contain a semicolon separating the "
-                'type from the arguments' % (i + 1, dsv_path))
+    for i, type_, remainder in lines:
         if type_ != DSV_TYPE_SOURCE:
             # handle non-source lines
             try:
@@ -258,7 +468,7 @@ def process_dsv_file(
     for basename, extensions in basenames.items():
         if not os.path.isabs(basename):
             basename = os.path.join(prefix, basename)
-        if os.path.exists(basename + '.dsv'):
+        if _inventory().exists(basename + '.dsv'):
             extensions.add('dsv')
 
     for basename, extensions in basenames.items():
@@ -271,20 +481,53 @@ def process_dsv_file(
                 additional_extension=additional_extension)
         elif primary_extension in extensions and len(extensions) == 1:
             # source primary-only files
-            commands += [
-                FORMAT_STR_INVOKE_SCRIPT.format_map({
-                    'prefix': prefix,
-                    'script_path': basename + '.' + primary_extension})]
+            commands += _invoke_script(
+                prefix, basename + '.' + primary_extension)
         elif additional_extension in extensions:
             # source non-primary files
-            commands += [
-                FORMAT_STR_INVOKE_SCRIPT.format_map({
-                    'prefix': prefix,
-                    'script_path': basename + '.' + additional_extension})]
+            commands += _invoke_script(
+                prefix, basename + '.' + additional_extension)
 
     return commands
 
 
+def _parse_dsv_file(dsv_path):
+    """
+    Split the lines of a dsv file.
+
+    :param str dsv_path: The path of the dsv file
+    :returns: The index, type and remainder of each non-empty line
+    :rtype: list
+    """
+    with open(dsv_path, 'r') as h:
+        content = h.read()
+    lines = content.splitlines()
+
+    parsed = []
+    for i, line in enumerate(lines):
+        # skip over empty or whitespace-only lines
+        if not line.strip():
+            continue
+        try:
+            type_, remainder = line.split(';', 1)
+        except ValueError:
+            raise RuntimeError(
+                "Line %d in '%s' doesn't contain a semicolon separating the "
+                'type from the arguments' % (i + 1, dsv_path))
+        parsed.append([i, type_, remainder])
+    return parsed
+
+
+def _invoke_script(prefix, script_path):
+    # the script may read or modify any variable, apply pending updates first
+    commands = _flush_pending_values()
+    commands.append(
+        FORMAT_STR_INVOKE_SCRIPT.format_map({
+            'prefix': prefix,
+            'script_path': script_path}))
+    return commands
+
+
 def handle_dsv_types_except_source(type_, remainder, prefix):
     commands = []
     if type_ in (DSV_TYPE_SET, DSV_TYPE_SET_IF_UNSET):
@@ -295,7 +538,7 @@ def handle_dsv_types_except_source(type_, remainder, prefix):
                 "doesn't contain a semicolon separating the environment name "
                 'from the value')
         try_prefixed_value = os.path.join(prefix, value) if value else prefix
-        if os.path.exists(try_prefixed_value):
+        if _inventory().exists(try_prefixed_value):
             value = try_prefixed_value
         if type_ == DSV_TYPE_SET:
             commands += _set(env_name, value)
@@ -323,7 +566,7 @@ def handle_dsv_types_except_source(type_, remainder, prefix):
                 value = os.path.join(prefix, value)
             if (
                 type_ == DSV_TYPE_PREPEND_NON_DUPLICATE_IF_EXISTS and
-                not os.path.exists(value)
+                not _inventory().exists(value)
             ):
                 if _include_comments():
                     comment = f'skip extending {env_name} with not existing ' \
@@ -341,13 +584,26 @@ def handle_dsv_types_except_source(type_, remainder, prefix):
 
 
 env_state = {}
+# values to prepend and append per variable which haven't been emitted yet
+pending_values = OrderedDict()
+# names of the environment variables the generated commands depend on
+env_reads = set()
+
+
+def _getenv(name):
+    global env_reads
+    if STATIC_OUTPUT:
+        # behave as if started from an empty environment
+        return None
+    env_reads.add(name)
+    return os.environ.get(name)
 
 
 def _append_unique_value(name, value):
     global env_state
     if name not in env_state:
-        if os.environ.get(name):
-            env_state[name] = set(os.environ[name].split(os.pathsep))
+        if _getenv(name):
+            env_state[name] = set(_getenv(name).split(os.pathsep))
         else:
             env_state[name] = set()
     # append even if the variable has not been set yet, in case a shell script sets the
@@ -358,6 +614,9 @@ def _append_unique_value(name, value):
         {'name': name, 'value': extend + value})
     if value not in env_state[name]:
         env_state[name].add(value)
+        if COALESCE_OUTPUT:
+            pending_values.setdefault(name, ([], []))[1].append(value)
+            return []
     else:
         if not _include_comments():
             return []
@@ -368,8 +627,8 @@ def _append_unique_value(name, value):
 def _prepend_unique_value(name, value):
     global env_state
     if name not in env_state:
-        if os.environ.get(name):
-            env_state[name] = set(os.environ[name].split(os.pathsep))
+        if _getenv(name):
+            env_state[name] = set(_getenv(name).split(os.pathsep))
         else:
             env_state[name] = set()
     # prepend even if the variable has not been set yet, in case a shell script sets the
@@ -380,6 +639,9 @@ def _prepend_unique_value(name, value):
         {'name': name, 'value': value + extend})
     if value not in env_state[name]:
         env_state[name].add(value)
+        if COALESCE_OUTPUT:
+            pending_values.setdefault(name, ([], []))[0].append(value)
+            return []
     else:
         if not _include_comments():
             return []
@@ -387,12 +649,37 @@ def _prepend_unique_value(name, value):
     return [line]
 
 
+def _flush_pending_values(name=None):
+    """
+    Emit the pending prepends and appends, one command per variable.
+
+    The last prepended value ends up first, like when each value is prepended
+    by a separate command.
+
+    :param str name: Only flush this variable, by default all are flushed
+    :returns: The commands
+    :rtype: list
+    """
+    global pending_values
+    commands = []
+    names = [name] if name is not None else list(pending_values.keys())
+    for name in names:
+        if name not in pending_values:
+            continue
+        prepends, appends = pending_values.pop(name)
+        values = list(reversed(prepends)) + \
+            [FORMAT_STR_USE_ENV_VAR.format_map({'name': name})] + appends
+        commands.append(FORMAT_STR_SET_ENV_VAR.format_map(
+            {'name': name, 'value': os.pathsep.join(values)}))
+    return commands
+
+
 def _remove_ending_separators():
     global env_state
     commands = []
     for name in env_state:
         # skip variables that already had values before this script started prepending
-        if name in os.environ:
+        if _getenv(name) is not None:
             continue
         commands += [
             FORMAT_STR_REMOVE_LEADING_SEPARATOR.format_map({'name': name}),
@@ -402,19 +689,25 @@ def _remove_ending_separators():
 
 def _set(name, value):
     global env_state
+    commands = _flush_pending_values(name)
     env_state[name] = value
     line = FORMAT_STR_SET_ENV_VAR.format_map(
         {'name': name, 'value': value})
-    return [line]
+    return commands + [line]
 
 
 def _set_if_unset(name, value):
     global env_state
+    commands = _flush_pending_values(name)
     line = FORMAT_STR_SET_ENV_VAR.format_map(
         {'name': name, 'value': value})
-    if env_state.get(name, os.environ.get(name)):
+    if env_state.get(name, _getenv(name)):
         line = FORMAT_STR_COMMENT_LINE.format_map({'comment': line})
-    return [line]
+    elif STATIC_OUTPUT and name not in env_state:
+        # defer the check to when the commands are sourced
+        line = FORMAT_STR_SET_ENV_VAR_IF_UNSET.format_map(
+            {'name': name, 'value': value})
+    return commands + [line]
 
 
 if __name__ == '__main__':  # pragma: no cover
@@ -95,14 +95,58 @@ ament_prepend_unique_value() {
   unset _listname
 }
 
+# record how long each phase and each sourced script takes, see the
+# "Environment Setup" section of the README
+if [ -n "$AUTOWARE_SETUP_PROFILE" ]; then
+  : > "$AUTOWARE_SETUP_PROFILE"
+  if [ "$AMENT_SHELL" = "zsh" ]; then
+    # provides EPOCHREALTIME which avoids forking `date`
+    zmodload zsh/datetime 2> /dev/null
+  fi
+  # first argument: the path of the script
+  _autoware_profile_source_script() {
+    _autoware_profile_hook_start=${EPOCHREALTIME:-`date +%s%6N`}
+    _ament_prefix_sh_source_script "$1"
+    printf 'hook\t%s\t%s\t%s\n' "$1" "$_autoware_profile_hook_start" "${EPOCHREALTIME:-`date +%s%6N`}" >> "$AUTOWARE_SETUP_PROFILE"
+    unset _autoware_profile_hook_start
+  }
+fi
+
+# use the commands flattened by the autoware-config dpkg trigger if possible:
+# they must be newer than the resource index, and since they don't deduplicate
+# against the current environment this prefix must not have been sourced yet;
+# they always cover all packages
+_ament_static_commands="$_ament_prefix_sh_AMENT_CURRENT_PREFIX/_local_setup_static.$AMENT_SHELL"
+_ament_use_static_commands=
+if [ -z "$AMENT_TRACE_SETUP_FILES" ] && [ -z "$AUTOWARE_SETUP_PACKAGES_UP_TO" ] && [ -z "$AUTOWARE_SETUP_PROFILE" ] && \
+  [ "$_ament_static_commands" -nt "$_ament_prefix_sh_AMENT_CURRENT_PREFIX/share/ament_index/resource_index/packages" ]; then
+  case ":$AMENT_PREFIX_PATH:" in
+    *":$_ament_prefix_sh_AMENT_CURRENT_PREFIX:"*) ;;
+    *) _ament_use_static_commands=1 ;;
+  esac
+fi
+
 # get all commands in topological order
 _ament_additional_extension=""
 if [ "$AMENT_SHELL" != "sh" ]; then
   _ament_additional_extension="${AMENT_SHELL}"
 fi
-_ament_ordered_commands="$($_ament_python_executable "$_ament_prefix_sh_AMENT_CURRENT_PREFIX/_local_setup_util.py" sh $_ament_additional_extension)"
+if [ -n "$_ament_use_static_commands" ]; then
+  _ament_ordered_commands=
+  . "$_ament_static_commands"
+else
+  if [ -n "$AUTOWARE_SETUP_PROFILE" ]; then
+    _autoware_profile_start=${EPOCHREALTIME:-`date +%s%6N`}
+  fi
+  # one export per path-like variable instead of one per value, if requested
+  _ament_ordered_commands="$($_ament_python_executable "$_ament_prefix_sh_AMENT_CURRENT_PREFIX/_local_setup_util.py" ${AUTOWARE_SETUP_COALESCE:+--coalesce} sh $_ament_additional_extension)"
+  if [ -n "$AUTOWARE_SETUP_PROFILE" ]; then
+    printf 'shell\tpython\t%s\t%s\n' "$_autoware_profile_start" "${EPOCHREALTIME:-`date +%s%6N`}" >> "$AUTOWARE_SETUP_PROFILE"
+  fi
+fi
+unset _ament_use_static_commands
+unset _ament_static_commands
 unset _ament_additional_extension
-unset _ament_python_executable
 if [ -n "$AMENT_TRACE_SETUP_FILES" ]; then
   echo "_ament_prefix_sh_source_script() {
     if [ -f \"\$1\" ]; then
@@ -120,8 +164,19 @@ if [ -n "$AMENT_TRACE_SETUP_FILES" ]; then
   echo "# >>>"
   echo "unset _ament_prefix_sh_source_script"
 fi
+if [ -n "$AUTOWARE_SETUP_PROFILE" ]; then
+  _autoware_profile_start=${EPOCHREALTIME:-`date +%s%6N`}
+fi
 eval "${_ament_ordered_commands}"
 unset _ament_ordered_commands
+if [ -n "$AUTOWARE_SETUP_PROFILE" ]; then
+  printf 'shell\tsource\t%s\t%s\n' "$_autoware_profile_start" "${EPOCHREALTIME:-`date +%s%6N`}" >> "$AUTOWARE_SETUP_PROFILE"
+  "$_ament_python_executable" "$_ament_prefix_sh_AMENT_CURRENT_PREFIX/_local_setup_util.py" --profile-report "$AUTOWARE_SETUP_PROFILE" --chrome-trace "$AUTOWARE_SETUP_PROFILE.json" > "$AUTOWARE_SETUP_PROFILE.txt" && \
+    echo "setup profile written to $AUTOWARE_SETUP_PROFILE.txt and $AUTOWARE_SETUP_PROFILE.json" 1>&2
+  unset -f _autoware_profile_source_script
+fi
+unset _autoware_profile_start
+unset _ament_python_executable
 
 unset _ament_prefix_sh_source_script
 
@@ -5,9 +5,27 @@ import yaml
 import sys
 import os
 import argparse
+import email.utils
+import hashlib
+import http.client
+import json
+import lzma
+import random
+import re
+import shutil
+import stat
+import subprocess
+import textwrap
+import threading
+import time
+import urllib.error
+import urllib.parse
 import urllib.request
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import nullcontext
 from pathlib import Path
-from datetime import datetime
+from datetime import datetime, timezone
 
 PACKAGE_NAME = "autoware-data"
 MAINTAINER = "Jerry Lin <jerry73204@gmail.com>"
@@ -15,26 +33,174 @@ DESCRIPTION = "Autoware ML model data files"
 INSTALL_DIR = "/opt/autoware/data"
 DEFAULT_GROUPS = "groups.yaml"
 
+# Per-model packages (--granular): one unsuffixed package per model directory,
+# named and versioned by its content hash and shared by every Autoware version,
+# so an upgrade only transfers the models that changed
+MODELS_DIR = "/opt/autoware/models"
+
+# Install-time dedup (--store): identical model files of all installed versions
+# are hardlinks of one entry in the store, the link count being the refcount
+STORE_DIR = "/opt/autoware/store"
+
+# Automatic grouping (--auto-groups): every topic deb must stay below GitHub's
+# 2 GiB release-asset limit, keep a margin for the estimation error
+DEFAULT_GROUP_LIMIT = "1.9G"
+DEFAULT_PROPOSED_GROUPS = "groups.proposed.yaml"
+# xz ratio observed on the 1.9.0 payload (2.78 GiB raw, 2.24 GiB deb), used for
+# files which aren't downloaded yet and therefore can't be sampled
+XZ_RATIO_DEFAULT = 0.8
+
+# Compressed-size preflight (--preflight): samples are compressed like dpkg-deb
+# does with each package's compression profile, at dpkg-deb's default level
+# unless the profile sets one. zstd samples need the zstd program.
+DPKG_DEB_LEVELS = {"xz": 6, "zstd": 3, "gzip": 9, "none": 0}
+SAMPLE_CHUNK = 128 << 10
+SAMPLE_CHUNKS = 8
+GITHUB_ASSET_LIMIT = 2 << 30
+
+# Compression of the debs: --compression, overridden by a group's `compression`
+# key, as ALGO[:level=N][:threads=N]. zstd needs a dpkg built with zstd support
+# (Ubuntu's is), threads needs dpkg-deb --threads-max of dpkg >= 1.21.9, which
+# jammy (1.21.1) lacks.
+DEFAULT_COMPRESSION = "xz"
+DPKG_THREADS_VERSION = (1, 21, 9)
+COMPRESSION_ALGORITHMS = ("xz", "zstd", "gzip", "none")
+COMPRESSION_REPORT = "debian/compression-report.txt"
+
+# Identical files within a binary package become hardlinks before it is built,
+# dpkg-deb stores them once and dpkg recreates the links (--dedup)
+DEDUP_REPORT = "debian/dedup-report.txt"
+# Hash of the inputs the debian files were generated from followed by the hash
+# of the generated files, and the hash of the files and inputs a build used
+# followed by the debs it built; equal hashes let just meta reuse the debs
+BUILD_STAMP = "debian/genpkg.stamp"
+BUILT_STAMP = "debian/genpkg.built"
+# Generated files in debian/ besides the *.postinst and *.postrm of --store
+DEBIAN_FILES = ("control", "rules", "changelog", "copyright", "source/format")
+# Arguments that change the generated debian files
+STAMP_ARGS = ("version", "suffix", "install_dir", "groups", "no_groups",
+              "compression", "granular", "store", "probe_sizes")
+
+# Content-addressed download cache shared by every tree on the build host
+CACHE_DIR_ENV = "AUTOWARE_DATA_CACHE"
+CACHE_SIZE_ENV = "AUTOWARE_DATA_CACHE_SIZE"
+DEFAULT_CACHE_SIZE = "50G"
+# aria2c input listing only the files the cache could not provide
+MISSING_DOWNLOADS = "downloads.missing.txt"
+
+# Pinned url, size, sha256 and ETag of every download, filled in by the build
+# steps and applied to tasks.yaml entries whose url is unchanged
+DOWNLOADS_LOCK = "downloads.lock"
+
+# Built-in downloader (--fetch), an alternative to aria2c
+FETCH_JOBS = 8
+FETCH_PER_HOST = 4
+FETCH_RETRIES = 5
+FETCH_TIMEOUT = 60
+FETCH_CHUNK = 1 << 20
+RETRY_BASE_DELAY = 2
+RETRY_MAX_DELAY = 60
+# transient HTTP errors, anything else (e.g. 404) fails immediately
+RETRY_HTTP_CODES = {408, 429, 500, 502, 503, 504}
+
+# aria2c input: largest downloads first, those spanning several ARIA2_SPLIT_SIZE
+# pieces split across several connections. aria2c runs ARIA2_JOBS downloads at a
+# time, possibly all from one host, so a download gets at most
+# FETCH_PER_HOST // ARIA2_JOBS connections to keep a host within FETCH_PER_HOST.
+# Sizes come from downloads/, the lock and the cache, HEAD requests only with
+# --probe-sizes
+ARIA2_JOBS = 2
+ARIA2_SPLIT_SIZE = 64 << 20
+SIZE_PROBE_TIMEOUT = 10
+
+# Conditional fetches of small files like tasks.yaml, revalidated against a copy
+# in the http/ directory of the download cache
+HTTP_TIMEOUT = 30
+
 # URL template for downloading tasks.yaml from Autoware repo
 TASKS_URL_TEMPLATE = "https://raw.githubusercontent.com/autowarefoundation/autoware/refs/tags/{version}/ansible/roles/artifacts/tasks/main.yaml"
 
 
-def download_tasks_yaml(version, output_path):
+def fetch_cached(url, cache_dir=None, timeout=HTTP_TIMEOUT):
+    """Fetch a small file, revalidating a cached copy of it.
+
+    The body, ETag and Last-Modified of every url are kept in the http/
+    directory of the download cache and sent back as If-None-Match and
+    If-Modified-Since. When the server can't be reached, or fails, the cached
+    copy is used as is. Returns the content and how it was obtained: 'fetched',
+    'not modified' or 'offline'. Without a cached copy errors are raised.
+    """
+    http_dir = Path(cache_dir or default_cache_dir()) / 'http'
+    key = hashlib.sha256(url.encode()).hexdigest()
+    body_path = http_dir / key
+    meta_path = http_dir / f"{key}.json"
+    meta = {}
+    if body_path.exists() and meta_path.exists():
+        try:
+            meta = json.loads(meta_path.read_text())
+        except (OSError, ValueError) as e:
+            # a truncated or garbled entry is a cache miss, the fetch rewrites it
+            print(f"Warning: ignoring the cache entry {meta_path}: {e}",
+                  file=sys.stderr)
+        if not isinstance(meta, dict):
+            meta = {}
+
+    headers = {}
+    if meta.get('etag'):
+        headers['If-None-Match'] = meta['etag']
+    if meta.get('last_modified'):
+        headers['If-Modified-Since'] = meta['last_modified']
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            content = response.read()
+            etag = response.headers.get('ETag')
+            last_modified = response.headers.get('Last-Modified')
+    except urllib.error.HTTPError as e:
+        if e.code == 304 and meta:
+            return body_path.read_bytes(), 'not modified'
+        if e.code < 500 or not meta:
+            raise
+        print(f"Warning: {url}: {e}; using the cached copy", file=sys.stderr)
+        return body_path.read_bytes(), 'offline'
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+        if not meta:
+            raise
+        print(f"Warning: {url}: {e}; using the cached copy", file=sys.stderr)
+        return body_path.read_bytes(), 'offline'
+
+    try:
+        http_dir.mkdir(parents=True, exist_ok=True)
+        for path, data in ((body_path, content), (meta_path, json.dumps({
+                'url': url, 'etag': etag, 'last_modified': last_modified,
+        }).encode())):
+            tmp = path.with_name(path.name + '.tmp')
+            tmp.write_bytes(data)
+            os.replace(tmp, path)
+    except OSError as e:
+        # the cache only saves requests, never fail the fetch because of it
+        print(f"Warning: cannot cache {url} in {http_dir}: {e}", file=sys.stderr)
+    return content, 'fetched'
+
+
+def download_tasks_yaml(version, output_path, cache_dir=None):
     """Download tasks.yaml from Autoware GitHub repository."""
     url = TASKS_URL_TEMPLATE.format(version=version)
     print(f"Downloading tasks.yaml from {url}...")
     try:
-        with urllib.request.urlopen(url) as response:
-            content = response.read().decode('utf-8')
-        output_path.write_text(content)
-        print(f"Saved to {output_path}")
-        return True
+        content, how = fetch_cached(url, cache_dir)
     except urllib.error.HTTPError as e:
         print(f"Error: Failed to download tasks.yaml: {e}", file=sys.stderr)
         return False
-    except urllib.error.URLError as e:
+    except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
         print(f"Error: Network error: {e}", file=sys.stderr)
         return False
+    output_path = Path(output_path)
+    # leave an unchanged file alone so that its mtime stays meaningful
+    if not output_path.exists() or output_path.read_bytes() != content:
+        output_path.write_bytes(content)
+    print(f"Saved to {output_path} ({how})")
+    return True
 
 
 def parse_ansible_yaml(file_path):
@@ -82,6 +248,68 @@ def extract_downloads(tasks):
     return downloads
 
 
+def load_lock(lock_path):
+    """Entries of a downloads.lock by destination path, {} if there is none."""
+    lock_path = Path(lock_path)
+    if not lock_path.exists():
+        return {}
+    data = yaml.safe_load(lock_path.read_text()) or {}
+    return data.get("files") or {}
+
+
+def apply_lock(downloads, files):
+    """Fill in the sha256 and size of downloads from their lock entries.
+
+    An entry only applies while its url is unchanged and tasks.yaml pins no
+    other checksum, so an upstream change always wins over the lock.
+    """
+    for dl in downloads:
+        locked = files.get(dl['dest_path'])
+        if not locked or locked.get('url') != dl['url']:
+            continue
+        if dl['sha256'] and locked.get('sha256') != dl['sha256']:
+            continue
+        dl['sha256'] = locked.get('sha256') or ''
+        dl['size'] = locked.get('size')
+    return downloads
+
+
+def update_lock(lock_path, entries, base_dir, etags=None):
+    """Record url, size, sha256 and ETag of the downloaded aria2c entries.
+
+    Files without a checksum in downloads.txt are hashed. An ETag is kept as
+    long as the url and checksum of its entry stay the same. The lock is only
+    rewritten if a record changed.
+    """
+    lock_path = Path(lock_path)
+    previous_files = load_lock(lock_path)
+    files = dict(previous_files)
+    for entry in entries:
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        if not dest.exists():
+            continue
+        sha256 = entry['sha256'] or sha256_file(dest)
+        previous = files.get(entry['out'], {})
+        etag = (etags or {}).get(entry['out'])
+        if etag is None and previous.get('url') == entry['url'] \
+                and previous.get('sha256') == sha256:
+            etag = previous.get('etag')
+        files[entry['out']] = {
+            'url': entry['url'],
+            'size': dest.stat().st_size,
+            'sha256': sha256,
+            'etag': etag,
+        }
+    if files == previous_files:
+        return
+    tmp = lock_path.with_name(lock_path.name + '.tmp')
+    tmp.write_text(
+        f"# Generated by genpkg.py from the downloads of {PACKAGE_NAME}, "
+        "commit it to pin them.\n"
+        + yaml.safe_dump({'files': files}, sort_keys=True))
+    os.replace(tmp, lock_path)
+
+
 def load_groups(groups_path):
     """Load the topic split definition. Returns None when no file is present."""
     groups_path = Path(groups_path)
@@ -135,6 +363,368 @@ def assign_groups(downloads, groups):
     return buckets
 
 
+def remote_size(url, timeout=FETCH_TIMEOUT):
+    """Content-Length of a URL from a HEAD request, None if unknown."""
+    request = urllib.request.Request(url, method='HEAD')
+    try:
+        with urllib.request.urlopen(request, timeout=timeout) as response:
+            length = response.headers.get('Content-Length')
+    except (urllib.error.URLError, http.client.HTTPException, OSError):
+        return None
+    return int(length) if length else None
+
+
+def probe_sizes(downloads, downloads_dir, cache_dir=None,
+                timeout=FETCH_TIMEOUT, probe=True):
+    """Size of every download, None if unknown.
+
+    Sizes come from downloads/, the lock or the download cache, the remaining
+    ones from parallel HEAD requests unless probe is false.
+    """
+    cache_dir = cache_dir or default_cache_dir()
+
+    def size(dl):
+        path = Path(downloads_dir) / dl['dest_path']
+        if path.exists():
+            return path.stat().st_size
+        if dl.get('size') is not None:
+            return dl['size']
+        if dl['sha256'] and _cache_path(cache_dir, dl['sha256']).exists():
+            return _cache_path(cache_dir, dl['sha256']).stat().st_size
+        return remote_size(dl['url'], timeout) if probe else None
+
+    with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+        return dict(zip((dl['dest_path'] for dl in downloads),
+                        executor.map(size, downloads)))
+
+
+DIFF_STATUSES = ("added", "changed", "moved", "removed", "unchanged")
+
+
+def diff_downloads(old, new):
+    """Join two download lists by destination path and checksum.
+
+    Returns (status, download) pairs with status one of DIFF_STATUSES; a
+    removed file is reported with its old entry, everything else with the new
+    one. A file whose checksum reappears under another path is moved rather
+    than added and removed, since it costs no new download.
+    """
+    def identity(dl):
+        return dl['sha256'] or dl['url']
+
+    old_by_path = {dl['dest_path']: dl for dl in old}
+    new_paths = {dl['dest_path'] for dl in new}
+    old_ids = {identity(dl) for dl in old}
+    new_ids = {identity(dl) for dl in new}
+
+    rows = []
+    for dl in new:
+        before = old_by_path.get(dl['dest_path'])
+        if before is None:
+            status = 'moved' if identity(dl) in old_ids else 'added'
+        elif identity(before) != identity(dl):
+            status = 'changed'
+        else:
+            status = 'unchanged'
+        rows.append((status, dl))
+    for dl in old:
+        if dl['dest_path'] not in new_paths and identity(dl) not in new_ids:
+            rows.append(('removed', dl))
+    return sorted(rows, key=lambda row: (DIFF_STATUSES.index(row[0]),
+                                         row[1]['dest_path']))
+
+
+def diff_sizes(rows, cache_dir):
+    """Size of every diffed download and whether the download cache has it.
+
+    Files in the cache are measured there, the others come from the lock or
+    HEAD requests.
+    """
+    def size(dl):
+        if dl['sha256']:
+            path = _cache_path(cache_dir, dl['sha256'])
+            if path.exists():
+                return path.stat().st_size, True
+        if dl.get('size') is not None:
+            return dl['size'], False
+        return remote_size(dl['url']), False
+
+    with ThreadPoolExecutor(max_workers=FETCH_JOBS) as executor:
+        return list(executor.map(lambda row: size(row[1]), rows))
+
+
+def print_diff(rows, sizes):
+    """Report every diffed file and the byte totals per status."""
+    mib = 1 << 20
+    print(f"{'status':<10} {'MiB':>10}  path")
+    for (status, dl), (size, cached) in zip(rows, sizes):
+        shown = f"{size / mib:.1f}" if size is not None else "?"
+        note = "  (cached)" if cached and status in ('added', 'changed') else ""
+        print(f"{status:<10} {shown:>10}  {dl['dest_path']}{note}")
+
+    print()
+    unknown = 0
+    for status in DIFF_STATUSES:
+        matched = [size for (s, _), (size, _) in zip(rows, sizes) if s == status]
+        unknown += matched.count(None)
+        total = sum(size or 0 for size in matched)
+        print(f"{status:<10} {len(matched):>4} files {total / mib:>10.1f} MiB")
+
+    fetched = [(size or 0, cached) for (s, _), (size, cached) in zip(rows, sizes)
+               if s in ('added', 'changed')]
+    total = sum(size for size, _ in fetched)
+    cached = sum(size for size, c in fetched if c)
+    print(f"\nNew data: {total / mib:.1f} MiB, "
+          f"{(total - cached) / mib:.1f} MiB not in the download cache")
+    if unknown:
+        print(f"Warning: the size of {unknown} files is unknown and counted as 0",
+              file=sys.stderr)
+
+
+def compressed_length(data, profile=DEFAULT_COMPRESSION):
+    """Length of data compressed with a compression profile, None if the
+    compressor isn't available."""
+    algorithm, options = split_compression(profile)
+    level = int(options.get('level', DPKG_DEB_LEVELS[algorithm]))
+    if algorithm == 'xz':
+        return len(lzma.compress(data, preset=level))
+    if algorithm == 'gzip':
+        return len(zlib.compress(data, level))
+    if algorithm == 'zstd':
+        if not shutil.which('zstd'):
+            return None
+        return len(subprocess.run(['zstd', '-q', '-c', f'-{level}'], input=data,
+                                  stdout=subprocess.PIPE, check=True).stdout)
+    return len(data)
+
+
+def sample_ratio(path, profile=DEFAULT_COMPRESSION, chunk_size=SAMPLE_CHUNK,
+                 chunks=SAMPLE_CHUNKS):
+    """Compress evenly spaced chunks of a file with the settings of the deb.
+
+    Files no larger than the sample are compressed whole. Returns the mean
+    and the worst compression ratio of the chunks, None if the profile's
+    compressor isn't available.
+    """
+    size = path.stat().st_size
+    if size == 0:
+        return 0.0, 0.0
+    if size <= chunk_size * chunks:
+        data = [path.read_bytes()]
+    else:
+        data = []
+        with open(path, 'rb') as f:
+            for i in range(chunks):
+                f.seek((size - chunk_size) * i // (chunks - 1))
+                data.append(f.read(chunk_size))
+    ratios = []
+    for chunk in data:
+        length = compressed_length(chunk, profile)
+        if length is None:
+            return None
+        ratios.append(length / len(chunk))
+    return sum(ratios) / len(ratios), max(ratios)
+
+
+def estimate_compressed_size(dl, path, size, profile=DEFAULT_COMPRESSION):
+    """Predict the compressed size of a download inside the deb.
+
+    Returns the estimate and an upper bound. A .tar.gz is extracted into the
+    package, but its content is about as hard to compress as the tarball
+    itself, so it counts as incompressible. Files which can't be sampled, not
+    downloaded yet or without the compressor, use XZ_RATIO_DEFAULT with xz
+    and their raw size otherwise, and are bounded by their raw size. Both are
+    None if the size is unknown.
+    """
+    if size is None:
+        return None, None
+    if dl['is_tarball']:
+        return size, size
+    ratios = sample_ratio(path, profile) if path.exists() else None
+    if ratios is None:
+        algorithm, _ = split_compression(profile)
+        default = XZ_RATIO_DEFAULT if algorithm == 'xz' else 1.0
+        return int(size * default), size
+    mean, worst = ratios
+    return int(size * mean), int(size * worst)
+
+
+def estimate_compressed_sizes(downloads, downloads_dir, sizes, profiles=None):
+    """estimate_compressed_size() of every download, sampled in parallel.
+
+    profiles maps destination paths to the compression profile of their
+    package, the others use DEFAULT_COMPRESSION.
+    """
+    profiles = profiles or {}
+
+    def estimate(dl):
+        path = Path(downloads_dir) / dl['dest_path']
+        return estimate_compressed_size(
+            dl, path, sizes[dl['dest_path']],
+            profiles.get(dl['dest_path'], DEFAULT_COMPRESSION))
+
+    # lzma, zlib and subprocess release the GIL while compressing
+    with ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        estimates = executor.map(estimate, downloads)
+        return {dl['dest_path']: e for dl, e in zip(downloads, estimates)}
+
+
+def print_preflight(buckets, estimates, sizes, limit=GITHUB_ASSET_LIMIT):
+    """Report the predicted deb size per binary package.
+
+    Returns False if the upper bound of any package exceeds the limit, or if
+    the size of one of its files is unknown.
+    """
+    mib = 1 << 20
+    ok = True
+    print(f"{'package':<40} {'raw':>10} {'estimate':>10} {'upper':>10}  MiB")
+    for name, items in buckets.items():
+        unknown = sum(1 for dl in items if sizes[dl['dest_path']] is None)
+        if unknown:
+            ok = False
+            print(f"{name:<40} {'unknown':>10} {'unknown':>10} {'unknown':>10}"
+                  f"  size of {unknown} files unknown")
+            continue
+        raw = sum(sizes[dl['dest_path']] for dl in items)
+        estimate = sum(estimates[dl['dest_path']][0] for dl in items)
+        upper = sum(estimates[dl['dest_path']][1] for dl in items)
+        status = ""
+        if upper > limit:
+            ok = False
+            status = "  OVER LIMIT" if estimate > limit else "  may exceed limit"
+        print(f"{name:<40} {raw / mib:>10.1f} {estimate / mib:>10.1f} "
+              f"{upper / mib:>10.1f}{status}")
+    return ok
+
+
+def pack_groups(dir_sizes, groups, limit):
+    """Assign top-level directories to groups by first-fit decreasing.
+
+    dir_sizes maps each directory to its estimated compressed size. The largest
+    directories are placed first; each stays in the group that already claims
+    it in `groups` if it fits there, otherwise it goes to the first group with
+    room left, opening a new group when none has. Returns the group to
+    directories mapping and the directories which exceed the limit on their
+    own.
+    """
+    affinity = {d: g for g, spec in groups.items() for d in spec.get("dirs", [])}
+    packed = {g: [] for g in groups}
+    totals = {g: 0 for g in groups}
+    oversized = []
+    for d in sorted(dir_sizes, key=lambda d: (-dir_sizes[d], d)):
+        size = dir_sizes[d]
+        if size > limit:
+            oversized.append(d)
+        candidates = [affinity[d]] if d in affinity else []
+        candidates += [g for g in packed if g not in candidates]
+        for g in candidates:
+            if totals[g] + size <= limit or (not packed[g] and size > limit):
+                break
+        else:
+            g = f"extra{sum(1 for n in packed if n.startswith('extra')) + 1}"
+            packed[g] = []
+            totals[g] = 0
+        packed[g].append(d)
+        totals[g] += size
+    # keep directories in their original order within each group
+    for g, dirs in packed.items():
+        order = groups.get(g, {}).get("dirs", [])
+        dirs.sort(key=lambda d: (order.index(d) if d in order else len(order), d))
+    return {g: dirs for g, dirs in packed.items() if dirs}, oversized
+
+
+def _yaml_entry(key, value, indent):
+    """One mapping entry as YAML lines, quoting the value where needed."""
+    text = yaml.safe_dump({key: value}, default_flow_style=False,
+                          sort_keys=False, allow_unicode=True, width=1 << 16)
+    return [(" " * indent + line).rstrip()
+            for line in text.rstrip("\n").splitlines()]
+
+
+def _yaml_scalar(value):
+    """A single-line value as a YAML scalar, quoted where needed."""
+    return yaml.safe_dump(value, width=1 << 16).splitlines()[0]
+
+
+def format_groups_yaml(packed, groups, dir_raw, dir_estimated, limit):
+    """Render a groups.yaml proposal, annotated with the size estimates.
+
+    Every key of a previous group is carried over, only its dirs change.
+    """
+    mib = 1 << 20
+    lines = [
+        "# Proposed by genpkg.py --auto-groups: top-level directories packed by",
+        "# first-fit decreasing on their estimated compressed size, keeping the",
+        "# groups of the previous groups file where they fit. Review the summary",
+        "# and description of groups whose directories changed.",
+        f"# Limit per package: {limit / mib:.1f} MiB compressed.",
+        "",
+        "groups:",
+    ]
+    for g, dirs in packed.items():
+        spec = groups.get(g, {})
+        raw = sum(dir_raw[d] for d in dirs)
+        estimated = sum(dir_estimated[d] for d in dirs)
+        summary = spec.get("summary", f"Autoware ML models ({g})")
+        description = spec.get("description", f"{summary}\n")
+        lines.append(f"  {g}:")
+        lines.append(f"    # {raw / mib:.1f} MiB raw, ~{estimated / mib:.1f} MiB "
+                     "compressed")
+        lines += _yaml_entry("summary", summary, 4)
+        if isinstance(description, str) and description.strip() and all(
+                line == line.strip() for line in description.splitlines()):
+            # keep the readable block style of the hand-written groups
+            lines.append("    description: |")
+            lines += [f"      {line}".rstrip()
+                      for line in description.rstrip().splitlines()]
+        else:
+            lines += _yaml_entry("description", description, 4)
+        for key, value in spec.items():
+            if key not in ("summary", "description", "dirs"):
+                lines += _yaml_entry(key, value, 4)
+        lines.append("    dirs:" if dirs else "    dirs: []")
+        lines += [f"      - {_yaml_scalar(d)}  # ~{dir_estimated[d] / mib:.1f} MiB"
+                  for d in dirs]
+        lines.append("")
+    return "\n".join(lines)
+
+
+def _package_slug(text):
+    """Lowercase a path into the characters allowed in a package name."""
+    return re.sub(r'[^a-z0-9]+', '-', text.lower()).strip('-')
+
+
+def granular_units(downloads):
+    """Split the downloads into one package per model directory.
+
+    A directory nested in another model directory stays with its ancestor.
+    Each unit's package name carries the hash of its destinations and
+    checksums, so unchanged models keep their package across Autoware versions.
+    """
+    parent_dirs = set(dl['parent_dir'] for dl in downloads)
+    units = {}
+    for dl in downloads:
+        parts = dl['parent_dir'].split('/')
+        unit = next('/'.join(parts[:i]) for i in range(1, len(parts) + 1)
+                    if '/'.join(parts[:i]) in parent_dirs)
+        units.setdefault(unit, []).append(dl)
+
+    result = []
+    for unit, items in sorted(units.items()):
+        content = "".join(f"{dl['dest_path']} {dl['sha256'] or dl['url']}\n"
+                          for dl in sorted(items, key=lambda d: d['dest_path']))
+        digest = hashlib.sha256(content.encode()).hexdigest()[:12]
+        slug = _package_slug(unit)
+        result.append({
+            'unit': unit,
+            'package': f"{PACKAGE_NAME}-{slug}-{digest}",
+            'version': f"0+{digest}",
+            'root': f"{MODELS_DIR}/{slug}-{digest}",
+            'downloads': items,
+        })
+    return result
+
+
 def _fmt_description_body(text):
     """Indent a description body for debian/control (one leading space per line)."""
     lines = []
@@ -144,28 +734,47 @@ def _fmt_description_body(text):
     return "\n".join(lines)
 
 
-def generate_control(suffix="", groups=None):
+def _granular_depends(units):
+    """Depends lines pinning the per-model packages of a payload package."""
+    return "".join(f",\n         {u['package']} (= {u['version']})"
+                   for u in units)
+
+
+def generate_control(suffix="", groups=None, granular=None):
     """Generate debian/control content.
 
     Without groups this emits the historical single binary package. With groups
     it emits one binary package per topic plus a metapackage depending on them
     all, so the payload can ship as several release assets that each stay under
-    GitHub's 2 GiB limit.
+    GitHub's 2 GiB limit. With granular units the models move into per-model
+    packages and the packages above depend on them.
     """
     source = f"{PACKAGE_NAME}{suffix}"
     header = f"""Source: {source}
 Section: misc
 Priority: optional
 Maintainer: {MAINTAINER}
-Build-Depends: debhelper-compat (= 13), aria2, ca-certificates
+Build-Depends: debhelper-compat (= 13), ca-certificates, python3,
+ python3-yaml
 Standards-Version: 4.6.2
 """
 
+    granular_stanzas = [f"""
+Package: {u['package']}
+Architecture: all
+Depends: ${{misc:Depends}}
+Description: {DESCRIPTION} ({u['unit']})
+{_fmt_description_body(textwrap.fill(
+    f"The {u['unit']} models, installed under {u['root']}. The package "
+    "name carries the hash of the model files, so it is shared by every "
+    "Autoware version using the same models.", 78))}
+""" for u in granular or []]
+
     if not groups:
         return header + f"""
 Package: {PACKAGE_NAME}{suffix}
 Architecture: all
-Depends: ${{misc:Depends}}
+Depends: ${{misc:Depends}}{_granular_depends(granular or [])}
 Description: {DESCRIPTION}
  This package contains pre-trained ML models and configuration files
  required by Autoware perception components including:
@@ -173,7 +782,7 @@ Description: {DESCRIPTION}
   - Camera-based 2D object detection models (YOLOX)
   - Traffic light classification models
   - Semantic segmentation models
-"""
+""" + "".join(granular_stanzas)
 
     stanzas = [header]
     names = [f"{PACKAGE_NAME}-{g}{suffix}" for g in groups]
@@ -196,100 +805,859 @@ Description: {DESCRIPTION} (metapackage)
     for group, spec in groups.items():
         summary = spec.get("summary", f"{DESCRIPTION} ({group})")
         body = _fmt_description_body(spec.get("description", summary))
+        dirs = spec.get("dirs", [])
+        units = [u for u in granular or []
+                 if u['unit'].split('/')[0] in dirs]
         stanzas.append(f"""
 Package: {PACKAGE_NAME}-{group}{suffix}
 Architecture: all
-Depends: ${{misc:Depends}}
+Depends: ${{misc:Depends}}{_granular_depends(units)}
 Description: {summary}
 {body}
 """)
 
-    return "".join(stanzas)
+    return "".join(stanzas + granular_stanzas)
+
+
+def aria2_connections(size, limit=FETCH_PER_HOST // ARIA2_JOBS):
+    """Connections for one download, one per ARIA2_SPLIT_SIZE bytes."""
+    if not size:
+        return 1
+    return max(1, min(limit, -(-size // ARIA2_SPLIT_SIZE)))
 
 
-def generate_aria2_input(downloads):
-    """Generate aria2c input file content."""
+def generate_aria2_input(downloads, sizes=None):
+    """Generate aria2c input file content.
+
+    With sizes the largest downloads come first, so that they don't end up
+    alone on a single connection at the end of the run, and the large ones are
+    split across several connections, within the per-host budget of the
+    ARIA2_JOBS concurrent downloads. Unknown sizes are scheduled first, the
+    files missing from downloads/ are the large ones.
+    """
+    sizes = sizes or {}
+    order = sorted(downloads, key=lambda dl: -sizes.get(dl['dest_path'])
+                   if sizes.get(dl['dest_path']) is not None else -float('inf'))
     lines = []
-    for dl in downloads:
+    for dl in order:
         lines.append(dl['url'])
         lines.append(f"  out={dl['dest_path']}")
         lines.append(f"  dir=downloads")
         if dl['sha256']:
             lines.append(f"  checksum=sha-256={dl['sha256']}")
+        connections = aria2_connections(sizes.get(dl['dest_path']))
+        if connections > 1:
+            lines.append(f"  split={connections}")
+            lines.append(f"  max-connection-per-server={connections}")
         lines.append("")  # Empty line between entries
     return "\n".join(lines)
 
 
-def _install_commands(downloads, destdir, install_dir):
-    """Install/extract commands for one binary package's staging directory."""
+def parse_aria2_input(text):
+    """Parse an aria2c input file into entries with url, dir, out and sha256.
+
+    Each entry keeps its original lines under 'block' so that a subset can be
+    written back unchanged.
+    """
+    entries = []
+    for line in text.splitlines():
+        if not line.strip():
+            continue
+        if not line[0].isspace():
+            entries.append({'url': line.strip(), 'dir': '.', 'out': '',
+                            'sha256': '', 'block': [line]})
+            continue
+        if not entries:
+            continue
+        entry = entries[-1]
+        entry['block'].append(line)
+        key, _, value = line.strip().partition('=')
+        if key in ('dir', 'out'):
+            entry[key] = value
+        elif key == 'checksum' and value.startswith('sha-256='):
+            entry['sha256'] = value.split('=', 1)[1]
+    return entries
+
+
+def default_cache_dir():
+    """Cache location: $AUTOWARE_DATA_CACHE or $XDG_CACHE_HOME/autoware-data."""
+    if os.environ.get(CACHE_DIR_ENV):
+        return Path(os.environ[CACHE_DIR_ENV])
+    cache_home = os.environ.get('XDG_CACHE_HOME') or Path.home() / '.cache'
+    return Path(cache_home) / 'autoware-data'
+
+
+def parse_size(text):
+    """Parse a byte count with an optional binary K/M/G/T suffix."""
+    text = str(text).strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30, 'T': 1 << 40}
+    if text and text[-1] in units:
+        return int(float(text[:-1]) * units[text[-1]])
+    return int(text)
+
+
+def sha256_file(path):
+    """Hash a file without reading it into memory at once."""
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _cache_path(cache_dir, sha256):
+    return Path(cache_dir) / 'sha256' / sha256[:2] / sha256
+
+
+def _link_or_copy(src, dst):
+    """Hardlink src to dst, copying across file systems, replacing dst."""
+    tmp = dst.with_name(f".{dst.name}.tmp{os.getpid()}")
+    if tmp.exists():
+        tmp.unlink()
+    try:
+        os.link(src, tmp)
+    except OSError:
+        shutil.copy2(src, tmp)
+    os.replace(tmp, dst)
+
+
+def _untar(archive, dest):
+    # pigz decompresses faster than gzip, use it if installed
+    program = 'pigz' if shutil.which('pigz') else 'gzip'
+    subprocess.run(['tar', f'--use-compress-program={program}', '-xf',
+                    str(archive), '-C', str(dest)], check=True)
+
+
+def extract_cached(archive, sha256, dest, cache_dir):
+    """Extract a tarball into dest through the extraction cache.
+
+    The tree unpacked from an archive is kept as extracted/<sha256> in the
+    download cache and copied into dest, reflinked where the file system
+    supports it, so an unchanged archive is only extracted once per host and
+    the packaging steps can't modify the cached tree. An archive is only
+    unpacked into the cache once it is verified, which is free if it is
+    hardlinked from the download cache.
+    Without a checksum, or if the cache is unusable, the archive is extracted
+    into dest directly. Returns 'cached' or 'extracted'.
+    """
+    dest = Path(dest)
+    dest.mkdir(parents=True, exist_ok=True)
+    if sha256:
+        cached = _cache_path(cache_dir, sha256)
+        verified = (cached.exists() and os.path.samefile(cached, archive)) \
+            or sha256_file(archive) == sha256
+        if not verified:
+            print(f"Warning: {archive} does not match sha256 {sha256}; "
+                  "not caching its extraction", file=sys.stderr)
+            sha256 = ''
+    if sha256:
+        tree = Path(cache_dir) / 'extracted' / sha256
+        status = 'cached'
+        try:
+            if not tree.is_dir():
+                status = 'extracted'
+                tmp = tree.with_name(f"{sha256}.tmp{os.getpid()}")
+                shutil.rmtree(tmp, ignore_errors=True)
+                tmp.mkdir(parents=True)
+                try:
+                    _untar(archive, tmp)
+                    os.rename(tmp, tree)
+                except (OSError, subprocess.CalledProcessError):
+                    shutil.rmtree(tmp, ignore_errors=True)
+                    if not tree.is_dir():
+                        raise
+            # the modification time orders the entries for eviction
+            os.utime(tree)
+            subprocess.run(['cp', '-a', '--reflink=auto', f"{tree}/.",
+                            str(dest)], check=True)
+            return status
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f"Warning: extraction cache {tree} unusable: {e}",
+                  file=sys.stderr)
+    _untar(archive, dest)
+    return 'extracted'
+
+
+def cache_link(entries, cache_dir, base_dir):
+    """Hardlink cached files into the build tree.
+
+    A file already present in the build tree with the expected checksum (e.g.
+    the small files tracked in git) is added to the cache instead. Returns the
+    entries which still have to be downloaded.
+    """
+    missing = []
+    hits = hit_bytes = 0
+    for entry in entries:
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        sha256 = entry['sha256']
+        if not sha256:
+            missing.append(entry)
+            continue
+        cached = _cache_path(cache_dir, sha256)
+        try:
+            if not (dest.exists() and os.path.samefile(cached, dest)):
+                dest.parent.mkdir(parents=True, exist_ok=True)
+                _link_or_copy(cached, dest)
+            # the modification time orders the entries for eviction
+            os.utime(cached)
+            hits += 1
+            hit_bytes += dest.stat().st_size
+            continue
+        except FileNotFoundError:
+            pass
+        if dest.exists() and sha256_file(dest) == sha256:
+            _cache_add(cache_dir, sha256, dest)
+            continue
+        missing.append(entry)
+    print(f"Cache {cache_dir}: {hits} files ({hit_bytes / (1 << 30):.2f} GiB) "
+          f"linked, {len(missing)} to download")
+    return missing
+
+
+def _cache_add(cache_dir, sha256, path):
+    cached = _cache_path(cache_dir, sha256)
+    if cached.exists():
+        return
+    cached.parent.mkdir(parents=True, exist_ok=True)
+    _link_or_copy(path, cached)
+
+
+def cache_store(entries, cache_dir, base_dir, max_size):
+    """Add downloaded files to the cache, then evict down to max_size bytes.
+
+    Files are verified before they are added, so a bad download never ends up
+    being shared with other builds.
+    """
+    for entry in entries:
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        sha256 = entry['sha256']
+        if not sha256 or not dest.exists():
+            continue
+        if _cache_path(cache_dir, sha256).exists():
+            continue
+        actual = sha256_file(dest)
+        if actual != sha256:
+            print(f"Warning: {dest} has sha256 {actual}, expected {sha256}; "
+                  "not caching it", file=sys.stderr)
+            continue
+        _cache_add(cache_dir, sha256, dest)
+    cache_evict(cache_dir, max_size)
+
+
+def _tree_size(tree):
+    """Bytes of the regular files below tree."""
+    size = 0
+    for root, _, names in os.walk(tree):
+        for name in names:
+            try:
+                st = os.lstat(os.path.join(root, name))
+            except FileNotFoundError:
+                continue
+            size += st.st_size if stat.S_ISREG(st.st_mode) else 0
+    return size
+
+
+def cache_evict(cache_dir, max_size):
+    """Remove the least recently used cache entries beyond max_size bytes.
+
+    The downloaded files and the extracted trees of tarballs both count
+    towards max_size, and are evicted by the time they were last used. Files
+    hardlinked into build trees stay valid there.
+    """
+    entries = []
+    for path in (Path(cache_dir) / 'sha256').glob('*/*'):
+        try:
+            st = path.stat()
+        except FileNotFoundError:
+            continue
+        entries.append((st.st_mtime, st.st_size, path))
+    extracted = Path(cache_dir) / 'extracted'
+    if extracted.is_dir():
+        for tree in extracted.iterdir():
+            # a .tmp tree is being extracted by a concurrent build
+            if '.tmp' in tree.name:
+                continue
+            try:
+                entries.append((tree.stat().st_mtime, _tree_size(tree), tree))
+            except FileNotFoundError:
+                continue
+    total = sum(size for _, size, _ in entries)
+    for _, size, path in sorted(entries):
+        if total <= max_size:
+            break
+        if path.parent == extracted:
+            # renamed first so that no build starts copying a partial tree
+            doomed = path.with_name(f"{path.name}.tmp{os.getpid()}")
+            try:
+                os.rename(path, doomed)
+            except FileNotFoundError:
+                continue
+            shutil.rmtree(doomed, ignore_errors=True)
+        else:
+            path.unlink(missing_ok=True)
+        total -= size
+        name = path.relative_to(path.parent.parent) \
+            if path.parent == extracted else path.name
+        print(f"Evicted {name} ({size / (1 << 20):.1f} MiB) from cache")
+
+
+def _range_start(headers):
+    """First byte of a 206 response by its Content-Range, None if unknown."""
+    match = re.match(r'bytes (\d+)-', headers.get('Content-Range') or '')
+    return int(match.group(1)) if match else None
+
+
+def _fetch_once(url, part, timeout):
+    """Download url into part, resuming an existing partial file.
+
+    The partial file is hashed first and the rest while it is written, so the
+    file is never read back after the download. Returns the sha256 hex digest
+    and the ETag of the response.
+    """
+    digest = hashlib.sha256()
+    offset = 0
+    if part.exists():
+        with open(part, 'rb') as f:
+            for chunk in iter(lambda: f.read(FETCH_CHUNK), b''):
+                digest.update(chunk)
+                offset += len(chunk)
+    headers = {'Range': f'bytes={offset}-'} if offset else {}
+    request = urllib.request.Request(url, headers=headers)
+    try:
+        response = urllib.request.urlopen(request, timeout=timeout)
+    except urllib.error.HTTPError as e:
+        if e.code == 416 and offset:
+            # nothing left to fetch, the partial file is complete
+            return digest.hexdigest(), e.headers.get('ETag')
+        raise
+    with response:
+        mode = 'ab'
+        if offset and response.status != 206:
+            # the server ignored the range, start over
+            digest = hashlib.sha256()
+            mode = 'wb'
+        elif offset and _range_start(response.headers) != offset:
+            # a body from another offset can't be appended, and without a
+            # checksum nothing would catch it, so download the file again
+            response.close()
+            part.unlink()
+            return _fetch_once(url, part, timeout)
+        received = 0
+        with open(part, mode) as f:
+            for chunk in iter(lambda: response.read(FETCH_CHUNK), b''):
+                f.write(chunk)
+                digest.update(chunk)
+                received += len(chunk)
+        length = response.headers.get('Content-Length')
+        if length and received < int(length):
+            # keep the partial file, the retry resumes it
+            raise http.client.IncompleteRead(b'', int(length) - received)
+    return digest.hexdigest(), response.headers.get('ETag')
+
+
+def fetch_file(url, dest, sha256='', retries=FETCH_RETRIES,
+               timeout=FETCH_TIMEOUT, host_slot=None):
+    """Download url to dest, verifying sha256 if given.
+
+    Interrupted transfers are resumed from dest.part with an HTTP Range
+    request. Transient failures and checksum mismatches are retried with
+    exponential backoff. host_slot optionally bounds the number of concurrent
+    connections to the host. Returns the ETag of the download.
+    """
+    dest = Path(dest)
+    dest.parent.mkdir(parents=True, exist_ok=True)
+    part = dest.with_name(dest.name + '.part')
+    for attempt in range(retries + 1):
+        if attempt:
+            delay = min(RETRY_BASE_DELAY * 2 ** (attempt - 1), RETRY_MAX_DELAY)
+            time.sleep(delay * random.uniform(0.5, 1.0))
+        try:
+            with host_slot or nullcontext():
+                actual, etag = _fetch_once(url, part, timeout)
+        except urllib.error.HTTPError as e:
+            if e.code not in RETRY_HTTP_CODES:
+                raise
+            error = e
+        except (urllib.error.URLError, http.client.HTTPException, OSError) as e:
+            error = e
+        else:
+            if not sha256 or actual == sha256:
+                os.replace(part, dest)
+                return etag
+            part.unlink()
+            error = ValueError(f"sha256 mismatch: got {actual}, expected {sha256}")
+        if attempt < retries:
+            print(f"Retrying {url} ({attempt + 1}/{retries}): {error}",
+                  file=sys.stderr)
+    raise error
+
+
+def fetch_all(entries, base_dir, jobs=FETCH_JOBS, per_host=FETCH_PER_HOST,
+              retries=FETCH_RETRIES, etags=None):
+    """Download aria2c input entries concurrently. Returns the failed entries.
+
+    Files which already exist and match their checksum are skipped. The ETags
+    of the downloaded files are collected in etags by output path.
+    """
+    slots = {}
+    for entry in entries:
+        host = urllib.parse.urlsplit(entry['url']).netloc
+        slots.setdefault(host, threading.Semaphore(per_host))
+    lock = threading.Lock()
+    done = []
+    failed = []
+
+    def fetch(entry):
+        dest = Path(base_dir) / entry['dir'] / entry['out']
+        sha256 = entry['sha256']
+        if dest.exists() and (not sha256 or sha256_file(dest) == sha256):
+            result = "present"
+        else:
+            host = urllib.parse.urlsplit(entry['url']).netloc
+            try:
+                etag = fetch_file(entry['url'], dest, sha256, retries,
+                                  host_slot=slots[host])
+                if etags is not None:
+                    etags[entry['out']] = etag
+                result = f"{dest.stat().st_size / (1 << 20):.1f} MiB"
+            except (ValueError, urllib.error.URLError,
+                    http.client.HTTPException, OSError) as e:
+                result = f"FAILED: {e}"
+                with lock:
+                    failed.append(entry)
+        with lock:
+            done.append(entry)
+            print(f"[{len(done)}/{len(entries)}] {entry['out']}: {result}")
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        list(executor.map(fetch, entries))
+    return failed
+
+
+def _stage_targets(name, downloads, destdir, install_dir):
+    """Make targets staging one binary package's files, by target name.
+
+    The plain files are copied from downloads/ by one target, every tarball is
+    extracted by a target of its own so that the extractions can run
+    concurrently. The files in downloads/ are hardlinks into the download
+    cache, so they are copied rather than linked, reflinked where the file
+    system supports it, and dh_fixperms can't change the cached files.
+    """
     cmds = [f'\tinstall -d {destdir}{install_dir}']
+    targets = {name: cmds}
+    created = set()
     for dl in downloads:
-        parent = dl['parent_dir']
-        dest_path = dl['dest_path']
-        cmds.append(f'\tinstall -d {destdir}{install_dir}/{parent}')
+        parent = f"{destdir}{install_dir}/{dl['parent_dir']}"
+        source = f"downloads/{dl['dest_path']}"
         if dl['is_tarball']:
-            cmds.append(f'\ttar -xf downloads/{dest_path} -C {destdir}{install_dir}/{parent}')
-        else:
-            cmds.append(f'\tinstall -m 644 downloads/{dest_path} {destdir}{install_dir}/{parent}/')
+            targets[f"{name}-{_package_slug(dl['dest_path'])}"] = [
+                f'\tinstall -d {parent}',
+                f'\tpython3 genpkg.py --extract {source} {parent}',
+            ]
+            continue
+        if parent not in created:
+            created.add(parent)
+            cmds.append(f'\tinstall -d {parent}')
+        cmds.append(f'\tcp --reflink=auto {source} {parent}/')
+    return targets
+
+
+def _model_link_commands(units, destdir, install_dir):
+    """Commands linking the model directories of per-model packages."""
+    cmds = [f'\tinstall -d {destdir}{install_dir}']
+    created = {f'{destdir}{install_dir}'}
+    for u in units:
+        link = f"{destdir}{install_dir}/{u['unit']}"
+        if os.path.dirname(link) not in created:
+            created.add(os.path.dirname(link))
+            cmds.append(f'\tinstall -d {os.path.dirname(link)}')
+        cmds.append(f"\tln -s {u['root']}/{u['unit']} {link}")
     return cmds
 
 
+def split_compression(profile):
+    """Algorithm and options of a compression profile, e.g. 'xz:level=9' gives
+    ('xz', {'level': '9'})."""
+    algorithm, *options = profile.split(':')
+    if algorithm not in COMPRESSION_ALGORITHMS:
+        raise ValueError(f"unknown compression '{algorithm}' in '{profile}', "
+                         f"expected one of {', '.join(COMPRESSION_ALGORITHMS)}")
+    parsed = {}
+    for option in options:
+        key, _, value = option.partition('=')
+        if key not in ('level', 'threads') or not value.isdigit():
+            raise ValueError(f"invalid option '{option}' in '{profile}', "
+                             "expected level=N or threads=N")
+        parsed[key] = value
+    return algorithm, parsed
+
+
+def parse_compression(profile):
+    """Translate a compression profile into dpkg-deb arguments."""
+    algorithm, options = split_compression(profile)
+    args = [f"-Z{algorithm}"]
+    if 'level' in options:
+        args.append(f"-z{options['level']}")
+    if 'threads' in options:
+        args.append(f"--threads-max={options['threads']}")
+    return args
+
+
+def dpkg_deb_version():
+    """Version of the installed dpkg-deb as a tuple, None without one."""
+    try:
+        output = subprocess.run(['dpkg-deb', '--version'], capture_output=True,
+                                text=True, check=True).stdout
+    except (OSError, subprocess.CalledProcessError):
+        return None
+    match = re.search(r'version (\d+(?:\.\d+)*)', output)
+    return tuple(int(n) for n in match.group(1).split('.')) if match else None
+
+
+def check_compression_support(profiles, version):
+    """Raise ValueError if a profile needs a newer dpkg-deb than version.
+
+    An unknown version, e.g. on a host without dpkg, isn't checked.
+    """
+    for profile in profiles:
+        if ('threads' in split_compression(profile)[1] and version
+                and version < DPKG_THREADS_VERSION):
+            raise ValueError(
+                f"compression '{profile}' needs dpkg-deb --threads-max of dpkg "
+                f">= {'.'.join(map(str, DPKG_THREADS_VERSION))}, this host has "
+                f"{'.'.join(map(str, version))}; drop its threads= option")
+
+
+def compression_profiles(suffix="", groups=None, default=DEFAULT_COMPRESSION,
+                         granular=None):
+    """Compression profile of every binary package, in build order.
+
+    A per-model package uses the profile of the group holding its models.
+    """
+    if not groups:
+        profiles = {f"{PACKAGE_NAME}{suffix}": default}
+        profiles.update((u['package'], default) for u in granular or [])
+        return profiles
+    profiles = {f"{PACKAGE_NAME}-{g}{suffix}": spec.get("compression", default)
+                for g, spec in groups.items()}
+    profiles[f"{PACKAGE_NAME}{suffix}"] = default
+    for u in granular or []:
+        top = u['unit'].split('/')[0]
+        profiles[u['package']] = next(
+            (spec.get("compression", default) for spec in groups.values()
+             if top in spec.get("dirs", [])), default)
+    return profiles
+
+
+def dedup_staging(staging):
+    """Hardlink identical files within a staging directory.
+
+    Only files sharing their size are hashed. Returns the number of files
+    replaced by a link and the bytes saved.
+    """
+    by_size = {}
+    for path in sorted(Path(staging).rglob('*')):
+        if path.is_file() and not path.is_symlink() \
+                and 'DEBIAN' not in path.relative_to(staging).parts:
+            by_size.setdefault(path.stat().st_size, []).append(path)
+    linked = saved = 0
+    for size, paths in by_size.items():
+        if size == 0 or len(paths) < 2:
+            continue
+        originals = {}
+        for path in paths:
+            original = originals.setdefault(sha256_file(path), path)
+            if os.path.samefile(original, path):
+                continue
+            tmp = path.with_name(path.name + '.dedup')
+            os.link(original, tmp)
+            os.replace(tmp, path)
+            linked += 1
+            saved += size
+    return linked, saved
+
+
+def dedup_packages(packages, package_dir, report_path):
+    """dedup_staging() every package and report the bytes saved."""
+    report_path = Path(package_dir) / report_path
+    lines = [f"{'package':<40} {'linked':>7} {'saved MiB':>10}"]
+    for package in packages:
+        linked, saved = dedup_staging(Path(package_dir) / 'debian' / package)
+        lines.append(f"{package:<40} {linked:>7} {saved / (1 << 20):>10.1f}")
+    report_path.write_text("\n".join(lines) + "\n")
+    print(report_path.read_text(), end="")
+
+
+def build_deb(package, profile, package_dir, report_path):
+    """Run dh_builddeb for one package and report its time and ratio."""
+    staging = Path(package_dir) / 'debian' / package
+    payload = sum(p.stat().st_size for p in staging.rglob('*')
+                  if p.is_file() and not p.is_symlink()
+                  and 'DEBIAN' not in p.relative_to(staging).parts)
+    start = time.monotonic()
+    subprocess.run(['dh_builddeb', '-p', package, '--',
+                    *parse_compression(profile)], cwd=package_dir, check=True)
+    elapsed = time.monotonic() - start
+    debs = sorted(Path(package_dir).resolve().parent.glob(f"{package}_*.deb"),
+                  key=lambda p: p.stat().st_mtime)
+    size = debs[-1].stat().st_size if debs else 0
+    ratio = size / payload if payload else 0.0
+    report_path = Path(package_dir) / report_path
+    new = not report_path.exists()
+    with open(report_path, 'a') as f:
+        if new:
+            f.write(f"{'package':<40} {'profile':<24} {'seconds':>8} "
+                    f"{'payload MiB':>12} {'deb MiB':>10} {'ratio':>6}\n")
+        f.write(f"{package:<40} {profile:<24} {elapsed:>8.1f} "
+                f"{payload / (1 << 20):>12.1f} {size / (1 << 20):>10.1f} "
+                f"{ratio:>6.3f}\n")
+
+
 def generate_rules(downloads, suffix="", install_dir=INSTALL_DIR, groups=None,
-                   buckets=None):
+                   buckets=None, compression=DEFAULT_COMPRESSION, granular=None):
     """Generate debian/rules content with aria2c for parallel downloads."""
     # Download directories are shared across every binary package.
     parent_dirs = sorted(set(dl['parent_dir'] for dl in downloads))
     mkdir_commands = [f'\tmkdir -p downloads/{d}' for d in parent_dirs]
 
-    install_commands = []
+    # With per-model packages the payload packages only link to the models.
+    def payload_targets(package, items):
+        destdir = f"$(CURDIR)/debian/{package}"
+        if not granular:
+            return _stage_targets(f"stage-{package}", items, destdir,
+                                  install_dir)
+        units = [u for u in granular
+                 if any(dl in items for dl in u['downloads'])]
+        return {f"stage-{package}":
+                _model_link_commands(units, destdir, install_dir)}
+
+    stage = {}
     if groups:
         for group in groups:
-            destdir = f"$(CURDIR)/debian/{PACKAGE_NAME}-{group}{suffix}"
-            install_commands.append(f'\t# --- {group} ---')
-            install_commands.extend(
-                _install_commands(buckets[group], destdir, install_dir))
+            stage.update(payload_targets(f"{PACKAGE_NAME}-{group}{suffix}",
+                                         buckets[group]))
         # Metapackage ships no payload; dh still needs its staging directory.
-        install_commands.append(f'\tinstall -d $(CURDIR)/debian/{PACKAGE_NAME}{suffix}')
+        stage[f"stage-{PACKAGE_NAME}{suffix}"] = [
+            f'\tinstall -d $(CURDIR)/debian/{PACKAGE_NAME}{suffix}']
     else:
-        destdir = f"$(CURDIR)/debian/{PACKAGE_NAME}{suffix}"
-        install_commands = _install_commands(downloads, destdir, install_dir)
+        stage.update(payload_targets(f"{PACKAGE_NAME}{suffix}", downloads))
+    for u in granular or []:
+        stage.update(_stage_targets(
+            f"stage-{u['package']}", u['downloads'],
+            f"$(CURDIR)/debian/{u['package']}", u['root']))
+    # Tarballs first: their extraction takes longest.
+    targets = sorted(stage, key=lambda t: any('--extract' in c for c in stage[t]),
+                     reverse=True)
+    stage_targets = "".join(f" \\\n\t{t}" for t in targets)
+    stage_rules = "".join(f"\n{t}:\n" + "\n".join(stage[t]) + "\n"
+                          for t in targets)
+
+    builddeb_commands = [
+        f'\tpython3 genpkg.py --builddeb {package} {profile}'
+        for package, profile in
+        compression_profiles(suffix, groups, compression, granular).items()]
+
+    # Per-model packages keep their version across source versions, so apt
+    # only sees an upgrade when the models themselves change.
+    gencontrol = ""
+    if granular:
+        gencontrol = "\noverride_dh_gencontrol:\n" + "".join(
+            f"\tdh_gencontrol -p {u['package']} -- -v{u['version']}\n"
+            for u in granular) + "\tdh_gencontrol --remaining-packages\n"
 
     return f"""#!/usr/bin/make -f
 
 export DH_VERBOSE = 1
 
+# Staging jobs: parallel=N of DEB_BUILD_OPTIONS, else one per CPU
+STAGE_JOBS := $(or $(patsubst parallel=%,%,$(filter parallel=%,$(DEB_BUILD_OPTIONS))),$(shell nproc))
+STAGE_TARGETS ={stage_targets}
+
 %:
 \tdh $@
 
 override_dh_auto_build:
 \t@echo "Creating download directories..."
 {chr(10).join(mkdir_commands)}
-\t@echo "Downloading model files with aria2c..."
-\taria2c -i downloads.txt -j 8 --continue=true --auto-file-renaming=false --allow-overwrite=true
+\t@echo "Linking model files from the download cache..."
+\tpython3 genpkg.py --cache-link
+\t@echo "Downloading model files..."
+\tif [ ! -s {MISSING_DOWNLOADS} ]; then \\
+\t\ttrue; \\
+\telif command -v aria2c > /dev/null; then \\
+\t\taria2c -i {MISSING_DOWNLOADS} -j {ARIA2_JOBS} --continue=true --auto-file-renaming=false --allow-overwrite=true; \\
+\telse \\
+\t\tpython3 genpkg.py --fetch {MISSING_DOWNLOADS}; \\
+\tfi
+\tpython3 genpkg.py --cache-store
 \t@echo "Downloads complete."
 
 override_dh_auto_install:
-{chr(10).join(install_commands)}
+\t$(MAKE) -f debian/rules -j$(STAGE_JOBS) $(STAGE_TARGETS)
+\tpython3 genpkg.py --dedup {' '.join(payload_packages(
+        downloads, suffix, install_dir, groups, buckets, granular))}
 
+.PHONY: $(STAGE_TARGETS)
+{stage_rules}
 override_dh_auto_clean:
-\trm -rf downloads/
+\trm -rf downloads/ {MISSING_DOWNLOADS} {BUILT_STAMP}
 
 override_dh_strip:
 \t# Skip stripping binary files (ONNX models)
 
 override_dh_shlibdeps:
 \t# Skip shared library dependency detection
-
+{gencontrol}
 override_dh_builddeb:
-\t# Use xz for ~15% smaller deb (important: stay under GitHub 2GB asset limit)
-\tdh_builddeb -- -Zxz
+\t# xz gives ~15% smaller debs (important: stay under GitHub 2GB asset limit);
+\t# each package is built with its compression profile and timed
+\trm -f {COMPRESSION_REPORT}
+{chr(10).join(builddeb_commands)}
+\tcat {COMPRESSION_REPORT}
+\t# record the debs built from these debian files for genpkg.py --up-to-date
+\tpython3 genpkg.py --record-build
+"""
+
+
+def payload_packages(downloads, suffix="", install_dir=INSTALL_DIR, groups=None,
+                     buckets=None, granular=None):
+    """Binary packages shipping model files, with their downloads and prefix."""
+    if granular:
+        return {u['package']: (u['downloads'], u['root']) for u in granular}
+    if groups:
+        return {f"{PACKAGE_NAME}-{g}{suffix}": (buckets[g], install_dir)
+                for g in groups}
+    return {f"{PACKAGE_NAME}{suffix}": (downloads, install_dir)}
+
+
+def store_entries(downloads, install_dir):
+    """(sha256, installed path) of the files that can live in the store.
+
+    Extracted tarballs are left out, their checksum covers the archive only.
+    """
+    return [(dl['sha256'], f"{install_dir}/{dl['dest_path']}")
+            for dl in downloads if dl['sha256'] and not dl['is_tarball']]
+
+
+def generate_store_postinst(entries):
+    """Generate a postinst linking a package's model files into the store."""
+    listing = "".join(f"{sha} {path}\n" for sha, path in entries)
+    return f"""#!/bin/sh
+set -e
+
+STORE={STORE_DIR}
+
+# Share the model files with the other versioned installs: a file whose
+# checksum is in the store already, and whose content is the same byte for
+# byte, is replaced by a hardlink to the entry, otherwise it becomes the entry. The link count of an entry is its refcount,
+# so dpkg removing any copy leaves the others intact, and postrm drops the
+# entries left with no copy but the store's own link.
+link_store() {{
+    mkdir -p "$STORE"
+    while read -r sha path; do
+        [ -f "$path" ] || continue
+        entry="$STORE/$sha"
+        if [ ! -f "$entry" ]; then
+            ln "$path" "$entry" 2>/dev/null || true
+        elif [ ! "$path" -ef "$entry" ] && cmp -s "$path" "$entry"; then
+            ln -f "$entry" "$path.dpkg-store" 2>/dev/null && \\
+                mv -f "$path.dpkg-store" "$path" || rm -f "$path.dpkg-store"
+        fi
+    done <<EOF
+{listing}EOF
+}}
+
+case "$1" in
+    configure)
+        link_store
+        ;;
+
+    abort-upgrade|abort-remove|abort-deconfigure)
+        # Do nothing
+        ;;
+
+    *)
+        echo "postinst called with unknown argument \\`$1'" >&2
+        exit 1
+        ;;
+esac
+
+#DEBHELPER#
+
+exit 0
+"""
+
+
+def generate_store_postrm(entries):
+    """Generate a postrm dropping the store entries no install references."""
+    listing = "".join(f"{sha}\n" for sha in sorted(set(sha for sha, _ in entries)))
+    return f"""#!/bin/sh
+set -e
+
+STORE={STORE_DIR}
+
+# dpkg has unlinked this package's copies, an entry with a link count of 1 is
+# referenced by no other installed package any more
+release_store() {{
+    [ -d "$STORE" ] || return 0
+    while read -r sha; do
+        entry="$STORE/$sha"
+        if [ -f "$entry" ] && [ "$(stat -c %h "$entry")" -le 1 ]; then
+            rm -f "$entry"
+        fi
+    done <<EOF
+{listing}EOF
+    rmdir "$STORE" 2>/dev/null || true
+}}
+
+case "$1" in
+    remove|purge|upgrade|disappear)
+        release_store
+        ;;
+
+    failed-upgrade|abort-install|abort-upgrade)
+        # Do nothing
+        ;;
+
+    *)
+        echo "postrm called with unknown argument \\`$1'" >&2
+        exit 1
+        ;;
+esac
+
+#DEBHELPER#
+
+exit 0
 """
 
 
-def generate_changelog(version="1.0.0", suffix=""):
+def changelog_header(version="1.0.0", suffix=""):
+    """First line of debian/changelog."""
+    return f"{PACKAGE_NAME}{suffix} ({version}-1) jammy; urgency=medium"
+
+
+def changelog_date(changelog_path, header):
+    """SOURCE_DATE_EPOCH, else the date of the existing changelog if it starts
+    with header, so that regenerating it leaves it unchanged while a new
+    version gets a new entry date, else the current time."""
+    epoch = os.environ.get('SOURCE_DATE_EPOCH')
+    if epoch:
+        return datetime.fromtimestamp(int(epoch), timezone.utc)
+    try:
+        lines = Path(changelog_path).read_text().splitlines()
+        if lines[0] != header:
+            return datetime.now(timezone.utc)
+        trailer = next(line for line in lines if line.startswith(' -- '))
+        return email.utils.parsedate_to_datetime(trailer.split('  ', 1)[1])
+    except (OSError, StopIteration, IndexError, TypeError, ValueError):
+        return datetime.now(timezone.utc)
+
+
+def generate_changelog(version="1.0.0", suffix="", date=None):
     """Generate debian/changelog content."""
-    date_str = datetime.now().strftime("%a, %d %b %Y %H:%M:%S +0000")
-    return f"""{PACKAGE_NAME}{suffix} ({version}-1) jammy; urgency=medium
+    date = (date or datetime.now(timezone.utc)).astimezone(timezone.utc)
+    date_str = date.strftime("%a, %d %b %Y %H:%M:%S +0000")
+    return f"""{changelog_header(version, suffix)}
 
   * Initial release
   * Package ML models for Autoware perception
@@ -329,30 +1697,122 @@ def generate_source_format():
     return "3.0 (native)\n"
 
 
+def _hash_files(paths):
+    """sha256 of genpkg.py itself and paths by name and content, a missing
+    file hashing differently from an empty one."""
+    digest = hashlib.sha256(Path(__file__).read_bytes())
+    for path in paths:
+        path = Path(path)
+        digest.update(f"\0{path.name}\0".encode())
+        if path.exists():
+            digest.update(b"\1" + path.read_bytes())
+    return digest
+
+
+def build_stamp(args, input_paths):
+    """Hash of everything the debian files are generated from: the input
+    files, genpkg.py itself, the arguments in STAMP_ARGS and SOURCE_DATE_EPOCH."""
+    digest = _hash_files(input_paths)
+    options = {name: getattr(args, name) for name in STAMP_ARGS}
+    options['SOURCE_DATE_EPOCH'] = os.environ.get('SOURCE_DATE_EPOCH')
+    digest.update(json.dumps(options, sort_keys=True).encode())
+    return digest.hexdigest()
+
+
+def read_stamp(path):
+    """Words of a stamp file, empty if there is none."""
+    try:
+        return Path(path).read_text().split()
+    except OSError:
+        return []
+
+
+def debian_hash(output_dir, input_paths=()):
+    """Hash of the generated debian files, downloads.txt and input_paths as
+    they are now."""
+    debian_dir = Path(output_dir) / 'debian'
+    return _hash_files([
+        Path(output_dir) / 'downloads.txt',
+        *(debian_dir / name for name in DEBIAN_FILES),
+        *sorted(debian_dir.glob('*.postinst')),
+        *sorted(debian_dir.glob('*.postrm')),
+        *input_paths,
+    ]).hexdigest()
+
+
+def debian_up_to_date(output_dir, stamp):
+    """Whether the debian files were generated from inputs hashing to stamp
+    and were not changed since."""
+    return (all((output_dir / 'debian' / name).exists()
+                for name in DEBIAN_FILES)
+            and (output_dir / 'downloads.txt').exists()
+            and read_stamp(output_dir / BUILD_STAMP)
+            == [stamp, debian_hash(output_dir)])
+
+
+def record_build(output_dir, input_paths):
+    """Write BUILT_STAMP: the debian_hash() of the files and inputs the build
+    used, followed by the debs listed in debian/files."""
+    lines = (output_dir / 'debian' / 'files').read_text().splitlines()
+    debs = [line.split()[0] for line in lines
+            if line.split() and line.split()[0].endswith('.deb')]
+    (output_dir / BUILT_STAMP).write_text(
+        "\n".join([debian_hash(output_dir, input_paths), *debs]) + "\n")
+
+
+def debs_up_to_date(output_dir, input_paths):
+    """Whether the debs of the last build are in the parent directory and were
+    built from the current debian files, downloads.txt and input_paths."""
+    built = read_stamp(output_dir / BUILT_STAMP)
+    if len(built) < 2 or built[0] != debian_hash(output_dir, input_paths):
+        return False
+    return all((output_dir.parent / deb).exists() for deb in built[1:])
+
+
 def write_debian_files(debian_dir, downloads, version="1.0.0", suffix="",
-                       install_dir=INSTALL_DIR, groups=None, buckets=None):
+                       install_dir=INSTALL_DIR, groups=None, buckets=None,
+                       compression=DEFAULT_COMPRESSION, granular=None,
+                       store=False, sizes=None):
     """Write all debian files to the specified directory."""
     debian_dir = Path(debian_dir)
     debian_dir.mkdir(parents=True, exist_ok=True)
 
     # Write downloads.txt (aria2c input file) in parent directory
     output_dir = debian_dir.parent
-    (output_dir / 'downloads.txt').write_text(generate_aria2_input(downloads))
+    (output_dir / 'downloads.txt').write_text(
+        generate_aria2_input(downloads, sizes))
     print(f"  Written: {output_dir / 'downloads.txt'}")
 
     # Write control
-    (debian_dir / 'control').write_text(generate_control(suffix, groups))
+    (debian_dir / 'control').write_text(generate_control(suffix, groups, granular))
     print(f"  Written: {debian_dir / 'control'}")
 
     # Write rules (needs to be executable)
     rules_path = debian_dir / 'rules'
     rules_path.write_text(
-        generate_rules(downloads, suffix, install_dir, groups, buckets))
+        generate_rules(downloads, suffix, install_dir, groups, buckets,
+                       compression, granular))
     rules_path.chmod(0o755)
     print(f"  Written: {rules_path}")
 
+    # Write the store maintainer scripts, dropping those of a previous run
+    for script in [*debian_dir.glob('*.postinst'), *debian_dir.glob('*.postrm')]:
+        script.unlink()
+    if store:
+        for package, (items, root) in payload_packages(
+                downloads, suffix, install_dir, groups, buckets,
+                granular).items():
+            entries = store_entries(items, root)
+            for name, content in (('postinst', generate_store_postinst(entries)),
+                                  ('postrm', generate_store_postrm(entries))):
+                (debian_dir / f'{package}.{name}').write_text(content)
+            print(f"  Written: {debian_dir / package}.{{postinst,postrm}}")
+
     # Write changelog
-    (debian_dir / 'changelog').write_text(generate_changelog(version, suffix))
+    changelog_path = debian_dir / 'changelog'
+    changelog_path.write_text(generate_changelog(
+        version, suffix,
+        changelog_date(changelog_path, changelog_header(version, suffix))))
     print(f"  Written: {debian_dir / 'changelog'}")
 
     # Write copyright
@@ -376,6 +1836,7 @@ Examples:
   %(prog)s --version 1.9.0            # Generate debian/ using existing tasks.yaml
   %(prog)s -o /path/to/pkg            # Generate debian/ in specified directory
   %(prog)s --download-only 1.9.0      # Only download tasks.yaml, don't generate
+  %(prog)s --diff old.yaml tasks.yaml   # Models a version bump adds or changes
 '''
     )
 
@@ -437,6 +1898,194 @@ Examples:
         help='Ignore the groups file and emit a single binary package'
     )
 
+    parser.add_argument(
+        '--granular',
+        action='store_true',
+        help='Move the models into one package per model directory, named by '
+             f'its content hash and installed under {MODELS_DIR}; the '
+             'packages above depend on them and link the directories into '
+             '--install-dir'
+    )
+
+    parser.add_argument(
+        '--store',
+        action='store_true',
+        help='Have the packages hardlink their model files into the '
+             f'content-addressed store {STORE_DIR}/<sha256> on install, so '
+             'the versioned installs share identical files'
+    )
+
+    parser.add_argument(
+        '--probe-sizes',
+        action='store_true',
+        help='Send a HEAD request for every download whose size is not known '
+             f'from downloads/, {DOWNLOADS_LOCK} or the download cache, to '
+             'order downloads.txt by size; without it the generation makes '
+             'no network requests'
+    )
+
+    parser.add_argument(
+        '--diff',
+        nargs=2,
+        metavar=('OLD_TASKS', 'NEW_TASKS'),
+        help='Report the model files added, changed, moved, removed and '
+             'unchanged between two tasks.yaml files with their sizes, from '
+             'the download cache or HEAD requests, then exit'
+    )
+
+    parser.add_argument(
+        '--cache-link',
+        action='store_true',
+        help='Build step: hardlink the files of downloads.txt from the download '
+             f'cache and list the rest in {MISSING_DOWNLOADS}'
+    )
+
+    parser.add_argument(
+        '--cache-store',
+        action='store_true',
+        help='Build step: add the verified downloads to the download cache and '
+             'evict the least recently used files beyond --cache-max-size'
+    )
+
+    parser.add_argument(
+        '--cache-dir',
+        help=f'Download cache shared by all trees (default: ${CACHE_DIR_ENV} or '
+             '~/.cache/autoware-data)'
+    )
+
+    parser.add_argument(
+        '--cache-max-size',
+        default=os.environ.get(CACHE_SIZE_ENV, DEFAULT_CACHE_SIZE),
+        help=f'Size bound of the download cache (default: ${CACHE_SIZE_ENV} or '
+             f'{DEFAULT_CACHE_SIZE})'
+    )
+
+    parser.add_argument(
+        '--fetch',
+        nargs='?',
+        const='downloads.txt',
+        metavar='INPUT',
+        help='Build step: download the entries of an aria2c input file '
+             '(default: downloads.txt) with the built-in downloader'
+    )
+
+    parser.add_argument(
+        '--lock',
+        action='store_true',
+        help=f'With --fetch or --cache-store, record the downloaded files in '
+             f'{DOWNLOADS_LOCK}; only the download step passes it, a package '
+             'build never writes to the source tree'
+    )
+
+    parser.add_argument(
+        '-j', '--jobs',
+        type=int,
+        default=FETCH_JOBS,
+        help=f'Concurrent downloads of --fetch (default: {FETCH_JOBS})'
+    )
+
+    parser.add_argument(
+        '--per-host',
+        type=int,
+        default=FETCH_PER_HOST,
+        help=f'Concurrent downloads of --fetch per host (default: {FETCH_PER_HOST})'
+    )
+
+    parser.add_argument(
+        '--retries',
+        type=int,
+        default=FETCH_RETRIES,
+        help=f'Retries per file of --fetch (default: {FETCH_RETRIES})'
+    )
+
+    parser.add_argument(
+        '--auto-groups',
+        nargs='?',
+        const=DEFAULT_PROPOSED_GROUPS,
+        metavar='OUTPUT',
+        help='Propose a groups file (default: '
+             f'{DEFAULT_PROPOSED_GROUPS}) packing the download directories '
+             'under --group-limit, then exit. Sizes come from downloads/, '
+             f'{DOWNLOADS_LOCK}, the download cache or HEAD requests; an '
+             'unknown size is an error.'
+    )
+
+    parser.add_argument(
+        '--group-limit',
+        default=DEFAULT_GROUP_LIMIT,
+        help='Estimated compressed size limit per topic package for '
+             f'--auto-groups (default: {DEFAULT_GROUP_LIMIT})'
+    )
+
+    parser.add_argument(
+        '--preflight',
+        action='store_true',
+        help='Predict the deb size of every binary package by compressing '
+             'samples of downloads/ and exit non-zero if one may exceed '
+             "GitHub's 2 GiB asset limit or the size of one of its files is "
+             'unknown, instead of generating debian files'
+    )
+
+    parser.add_argument(
+        '--compression',
+        default=DEFAULT_COMPRESSION,
+        metavar='PROFILE',
+        help='Compression of the debs as ALGO[:level=N][:threads=N] with ALGO '
+             f'one of {", ".join(COMPRESSION_ALGORITHMS)}, e.g. '
+             'xz:level=6:threads=0 or zstd:level=19; a group can override it '
+             f'with a compression key (default: {DEFAULT_COMPRESSION})'
+    )
+
+    parser.add_argument(
+        '--extract',
+        nargs=2,
+        metavar=('ARCHIVE', 'DEST'),
+        help='Build step: extract a tarball of downloads.txt into DEST by '
+             'copying the tree cached under its sha256, unpacking it into '
+             'the download cache first if needed'
+    )
+
+    parser.add_argument(
+        '--dedup',
+        nargs='+',
+        metavar='PACKAGE',
+        help='Build step: replace identical files within the staging '
+             'directory of each PACKAGE by hardlinks and write the bytes '
+             f'saved to {DEDUP_REPORT}'
+    )
+
+    parser.add_argument(
+        '--builddeb',
+        nargs=2,
+        metavar=('PACKAGE', 'PROFILE'),
+        help='Build step: run dh_builddeb for PACKAGE with the compression '
+             f'PROFILE and append its time and ratio to {COMPRESSION_REPORT}'
+    )
+
+    parser.add_argument(
+        '--force',
+        action='store_true',
+        help='Regenerate the debian files even if tasks.yaml, the groups '
+             'file, downloads.lock, genpkg.py and the arguments hash to the '
+             f'same {BUILD_STAMP} as last time'
+    )
+
+    parser.add_argument(
+        '--up-to-date',
+        action='store_true',
+        help='Exit 0 if the debs of the last build are still in the parent '
+             'directory and were built from the current debian files, '
+             'downloads.txt, tasks.yaml, groups file and downloads.lock, 1 if '
+             'the package needs a dpkg-buildpackage'
+    )
+
+    parser.add_argument(
+        '--record-build',
+        action='store_true',
+        help=f'Build step: record the debs of debian/files in {BUILT_STAMP} '
+             'with the hash of the files they were built from, for --up-to-date'
+    )
+
     args = parser.parse_args()
 
     # Resolve paths
@@ -449,16 +2098,107 @@ Examples:
     if not output_dir.is_absolute():
         output_dir = script_dir / output_dir
 
+    # The inputs of the generation, a build depends on them as well
+    input_paths = [tasks_path, script_dir / args.groups,
+                   output_dir / DOWNLOADS_LOCK]
+
+    if args.record_build:
+        record_build(output_dir, input_paths)
+        sys.exit(0)
+
+    if args.up_to_date:
+        sys.exit(0 if debs_up_to_date(output_dir, input_paths) else 1)
+
+    # Build steps around the download of downloads.txt
+    if args.cache_link or args.cache_store:
+        cache_dir = Path(args.cache_dir) if args.cache_dir else default_cache_dir()
+        entries = parse_aria2_input((output_dir / 'downloads.txt').read_text())
+        missing = entries
+        try:
+            if args.cache_link:
+                missing = cache_link(entries, cache_dir, output_dir)
+            else:
+                cache_store(entries, cache_dir, output_dir,
+                            parse_size(args.cache_max_size))
+                if args.lock:
+                    update_lock(output_dir / DOWNLOADS_LOCK, entries, output_dir)
+        except OSError as e:
+            # the cache only saves time, never fail the build because of it
+            print(f"Warning: download cache {cache_dir} unusable: {e}",
+                  file=sys.stderr)
+        if args.cache_link:
+            (output_dir / MISSING_DOWNLOADS).write_text(
+                "\n".join("\n".join(e['block']) + "\n" for e in missing))
+        sys.exit(0)
+
+    if args.diff:
+        old_tasks, new_tasks = (parse_ansible_yaml(path) for path in args.diff)
+        if not old_tasks or not new_tasks:
+            print("Error: No valid tasks found in YAML file", file=sys.stderr)
+            sys.exit(1)
+        old, new = (
+            apply_lock(extract_downloads(tasks),
+                       load_lock(Path(path).with_name(DOWNLOADS_LOCK)))
+            for tasks, path in zip((old_tasks, new_tasks), args.diff))
+        rows = diff_downloads(old, new)
+        cache_dir = Path(args.cache_dir) if args.cache_dir else default_cache_dir()
+        print_diff(rows, diff_sizes(rows, cache_dir))
+        sys.exit(0)
+
+    if args.extract:
+        archive, dest = args.extract
+        entries = parse_aria2_input((output_dir / 'downloads.txt').read_text())
+        sha256 = next((e['sha256'] for e in entries
+                       if os.path.normpath(os.path.join(e['dir'], e['out']))
+                       == os.path.normpath(archive)), '')
+        cache_dir = Path(args.cache_dir) if args.cache_dir else default_cache_dir()
+        status = extract_cached(output_dir / archive, sha256, dest, cache_dir)
+        print(f"{archive}: {status}")
+        sys.exit(0)
+
+    if args.dedup:
+        dedup_packages(args.dedup, output_dir, DEDUP_REPORT)
+        sys.exit(0)
+
+    if args.builddeb:
+        package, profile = args.builddeb
+        try:
+            check_compression_support([profile], dpkg_deb_version())
+        except ValueError as e:
+            print(f"Error: {package}: {e}", file=sys.stderr)
+            sys.exit(1)
+        build_deb(package, profile, output_dir, COMPRESSION_REPORT)
+        sys.exit(0)
+
+    if args.fetch:
+        input_path = Path(args.fetch)
+        if not input_path.is_absolute():
+            input_path = output_dir / input_path
+        entries = parse_aria2_input(input_path.read_text())
+        etags = {}
+        failed = fetch_all(entries, output_dir, args.jobs, args.per_host,
+                           args.retries, etags)
+        if args.lock:
+            update_lock(output_dir / DOWNLOADS_LOCK,
+                        [e for e in entries if e['out'] in etags], output_dir,
+                        etags)
+        if failed:
+            print(f"Error: {len(failed)} of {len(entries)} downloads failed",
+                  file=sys.stderr)
+            sys.exit(1)
+        sys.exit(0)
+
     # Handle download-only mode
     if args.download_only:
-        if not download_tasks_yaml(args.download_only, tasks_path):
+        if not download_tasks_yaml(args.download_only, tasks_path,
+                                   args.cache_dir):
             sys.exit(1)
         print("\nDownload complete. Run without --download-only to generate debian files.")
         sys.exit(0)
 
     # Download tasks.yaml if requested
     if args.download:
-        if not download_tasks_yaml(args.download, tasks_path):
+        if not download_tasks_yaml(args.download, tasks_path, args.cache_dir):
             sys.exit(1)
         # Use download tag as version if not explicitly set
         if args.version == '1.0.0':
@@ -480,6 +2220,66 @@ Examples:
     # Extract download information
     downloads = extract_downloads(tasks)
     print(f"Found {len(downloads)} files to download")
+    lock_path = output_dir / DOWNLOADS_LOCK
+    unpinned = [dl for dl in downloads if not dl['sha256']]
+    apply_lock(downloads, load_lock(lock_path))
+    if unpinned:
+        pinned = sum(1 for dl in unpinned if dl['sha256'])
+        print(f"  {len(unpinned)} without a checksum in {tasks_path.name}, "
+              f"{pinned} of them pinned by {lock_path.name}")
+
+    if args.auto_groups:
+        groups_path = Path(args.groups)
+        if not groups_path.is_absolute():
+            groups_path = script_dir / groups_path
+        groups = {} if args.no_groups else load_groups(groups_path) or {}
+        limit = parse_size(args.group_limit)
+        # a directory keeps the compression of the group claiming it
+        dir_profiles = {d: spec.get('compression', args.compression)
+                        for spec in groups.values() for d in spec.get('dirs') or []}
+        profiles = {dl['dest_path']: dir_profiles.get(
+                        dl['parent_dir'].split('/')[0], args.compression)
+                    for dl in downloads}
+        try:
+            for profile in set(profiles.values()):
+                split_compression(profile)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        # packing files of unknown size as 0 bytes would be a wrong proposal
+        sizes = probe_sizes(downloads, output_dir / 'downloads', args.cache_dir)
+        unknown = [dl for dl in downloads if sizes[dl['dest_path']] is None]
+        if unknown:
+            for dl in unknown:
+                print(f"Error: size of {dl['url']} unknown", file=sys.stderr)
+            print(f"Error: the size of {len(unknown)} files is unknown; run "
+                  "just download-data, or --auto-groups with network access",
+                  file=sys.stderr)
+            sys.exit(1)
+        estimates = estimate_compressed_sizes(
+            downloads, output_dir / 'downloads', sizes, profiles)
+        dir_raw = {}
+        dir_estimated = {}
+        for dl in downloads:
+            top = dl['parent_dir'].split('/')[0]
+            dir_raw[top] = dir_raw.get(top, 0) + sizes[dl['dest_path']]
+            dir_estimated[top] = (dir_estimated.get(top, 0)
+                                  + estimates[dl['dest_path']][0])
+        packed, oversized = pack_groups(dir_estimated, groups, limit)
+        for d in oversized:
+            print(f"Error: '{d}' alone is estimated at "
+                  f"{dir_estimated[d] / (1 << 20):.1f} MiB, over the limit",
+                  file=sys.stderr)
+        proposal_path = Path(args.auto_groups)
+        if not proposal_path.is_absolute():
+            proposal_path = script_dir / proposal_path
+        proposal_path.write_text(
+            format_groups_yaml(packed, groups, dir_raw, dir_estimated, limit))
+        for g, dirs in packed.items():
+            estimated = sum(dir_estimated[d] for d in dirs)
+            print(f"  {g}: {len(dirs)} dirs, ~{estimated / (1 << 20):.1f} MiB")
+        print(f"Written: {proposal_path}")
+        sys.exit(1 if oversized else 0)
 
     # Resolve the topic split
     groups = buckets = None
@@ -499,11 +2299,84 @@ Examples:
             print(f"No groups file at {groups_path}; "
                   "generating a single package")
 
+    if args.preflight:
+        if not buckets:
+            buckets = {None: downloads}
+        buckets = {
+            f"{PACKAGE_NAME}-{g}{args.suffix}" if g else f"{PACKAGE_NAME}{args.suffix}": items
+            for g, items in buckets.items()}
+        try:
+            package_profiles = compression_profiles(
+                args.suffix, groups, args.compression)
+            for profile in package_profiles.values():
+                split_compression(profile)
+        except ValueError as e:
+            print(f"Error: {e}", file=sys.stderr)
+            sys.exit(1)
+        profiles = {dl['dest_path']: package_profiles[name]
+                    for name, items in buckets.items() for dl in items}
+        # an unknown size fails the check instead of counting as 0 bytes
+        sizes = probe_sizes(downloads, output_dir / 'downloads', args.cache_dir)
+        estimates = estimate_compressed_sizes(
+            downloads, output_dir / 'downloads', sizes, profiles)
+        unknown = [dl for dl in downloads if sizes[dl['dest_path']] is None]
+        for dl in unknown:
+            print(f"Warning: size of {dl['url']} unknown", file=sys.stderr)
+        unsampled = [dl for dl in downloads
+                     if not (output_dir / 'downloads' / dl['dest_path']).exists()
+                     and sizes[dl['dest_path']] is not None]
+        if unsampled:
+            print(f"Warning: {len(unsampled)} files are not in downloads/ yet; "
+                  f"assuming a ratio of {XZ_RATIO_DEFAULT} for them with xz, "
+                  "their raw size otherwise", file=sys.stderr)
+        print()
+        ok = print_preflight(buckets, estimates, sizes)
+        if unknown:
+            print(f"\nError: the size of {len(unknown)} files is unknown; run "
+                  "just download-data, or the preflight with network access",
+                  file=sys.stderr)
+        sys.exit(0 if ok else 1)
+
+    granular = None
+    if args.granular:
+        granular = granular_units(downloads)
+        print(f"Moving the models into {len(granular)} per-model packages")
+
+    # Fail now rather than in dh_builddeb at the end of a long build
+    try:
+        profiles = compression_profiles(
+            args.suffix, groups, args.compression, granular).values()
+        for profile in profiles:
+            parse_compression(profile)
+        check_compression_support(profiles, dpkg_deb_version())
+    except ValueError as e:
+        print(f"Error: {e}", file=sys.stderr)
+        sys.exit(1)
+
+    # Skip the generation when none of its inputs changed since the last run
+    stamp = build_stamp(args, input_paths)
+    if not args.force and debian_up_to_date(output_dir, stamp):
+        print(f"\n{output_dir / 'debian'} is up to date with its inputs "
+              f"({BUILD_STAMP}), skipping the generation; --force regenerates it")
+        sys.exit(0)
+
+    # Sizes schedule the largest downloads first in downloads.txt
+    sizes = probe_sizes(downloads, output_dir / 'downloads', args.cache_dir,
+                        SIZE_PROBE_TIMEOUT, args.probe_sizes)
+    unknown = sum(1 for size in sizes.values() if size is None)
+    if unknown:
+        print(f"Size of {unknown} downloads unknown, scheduling them first"
+              + ("" if args.probe_sizes else "; --probe-sizes asks the server"))
+
     # Generate debian files
     debian_dir = output_dir / 'debian'
     print(f"\nGenerating debian files in {debian_dir}...")
     write_debian_files(debian_dir, downloads, args.version, args.suffix,
-                       args.install_dir, groups, buckets)
+                       args.install_dir, groups, buckets, args.compression,
+                       granular, args.store, sizes)
+    (output_dir / BUILD_STAMP).write_text(
+        f"{stamp} {debian_hash(output_dir)}\n")
+    print(f"  Written: {output_dir / BUILD_STAMP}")
 
     print(f"\nDone! To build the package:")
     print(f"  cd {output_dir}")
@@ -0,0 +1,201 @@
+#!/usr/bin/env python3
+"""Tests of the built-in downloader of genpkg.py against a local HTTP server.
+
+Run from the package directory with:
+  python3 -m unittest discover tests
+"""
+
+import hashlib
+import http.server
+import importlib.util
+import tempfile
+import threading
+import unittest
+import urllib.error
+from pathlib import Path
+
+GENPKG = Path(__file__).resolve().parents[1] / 'genpkg.py'
+spec = importlib.util.spec_from_file_location('genpkg', GENPKG)
+genpkg = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(genpkg)
+
+BODY = bytes(range(256)) * 4096  # 1 MiB
+BODY_SHA256 = hashlib.sha256(BODY).hexdigest()
+
+
+class Handler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY under paths which misbehave in different ways.
+
+    /file        honors Range requests
+    /norange     ignores Range requests and always answers 200
+    /badrange    answers Range requests with a 206 from a later offset
+    /truncated   sends the first response only halfway, then honors Range
+    /flaky       answers 503 to the first two requests
+    /missing     answers 404
+    """
+
+    def do_GET(self):
+        server = self.server
+        with server.lock:
+            server.requests.append((self.path, self.headers.get('Range')))
+            count = sum(1 for path, _ in server.requests if path == self.path)
+        if self.path == '/missing':
+            self.send_error(404)
+        elif self.path == '/flaky' and count <= 2:
+            self.send_error(503)
+        elif self.path == '/truncated' and count == 1:
+            self.send_response(200)
+            self.send_header('Content-Length', str(len(BODY)))
+            self.end_headers()
+            self.wfile.write(BODY[:len(BODY) // 2])
+            self.close_connection = True
+        else:
+            self._send_body(self.path != '/norange',
+                            skew=16 if self.path == '/badrange' else 0)
+
+    def _send_body(self, ranges, skew=0):
+        offset = 0
+        requested = self.headers.get('Range')
+        if ranges and requested:
+            offset = int(requested.split('=')[1].rstrip('-')) + skew
+            if offset >= len(BODY):
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header('Content-Range',
+                             f'bytes {offset}-{len(BODY) - 1}/{len(BODY)}')
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(BODY) - offset))
+        self.send_header('ETag', '"body"')
+        self.end_headers()
+        self.wfile.write(BODY[offset:])
+
+    def log_message(self, *args):
+        pass
+
+
+class FetchTest(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        cls.server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        cls.server.lock = threading.Lock()
+        cls.thread = threading.Thread(target=cls.server.serve_forever,
+                                      daemon=True)
+        cls.thread.start()
+        cls.base_url = f'http://127.0.0.1:{cls.server.server_port}'
+        # retry without waiting
+        cls.base_delay = genpkg.RETRY_BASE_DELAY
+        genpkg.RETRY_BASE_DELAY = 0
+
+    @classmethod
+    def tearDownClass(cls):
+        genpkg.RETRY_BASE_DELAY = cls.base_delay
+        cls.server.shutdown()
+        cls.server.server_close()
+
+    def setUp(self):
+        self.server.requests = []
+        tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(tmp.cleanup)
+        self.dest = Path(tmp.name) / 'model.onnx'
+        self.part = self.dest.with_name('model.onnx.part')
+
+    def fetch(self, path, sha256=BODY_SHA256, retries=3):
+        return genpkg.fetch_file(self.base_url + path, self.dest, sha256,
+                                 retries=retries, timeout=5)
+
+    def test_resumes_partial_file_with_range(self):
+        self.part.write_bytes(BODY[:1000])
+        self.assertEqual(self.fetch('/file'), '"body"')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+        self.assertFalse(self.part.exists())
+        self.assertEqual(self.server.requests, [('/file', 'bytes=1000-')])
+
+    def test_resumes_interrupted_transfer(self):
+        self.fetch('/truncated')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+        self.assertEqual(self.server.requests, [
+            ('/truncated', None),
+            ('/truncated', f'bytes={len(BODY) // 2}-'),
+        ])
+
+    def test_restarts_when_range_is_ignored(self):
+        self.part.write_bytes(b'stale bytes which must not be kept')
+        self.fetch('/norange')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+        self.assertEqual(len(self.server.requests), 1)
+
+    def test_restarts_when_range_is_misplaced(self):
+        self.part.write_bytes(BODY[:1000])
+        # without a checksum only the Content-Range check prevents corruption
+        self.fetch('/badrange', sha256='')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+        self.assertEqual(self.server.requests, [
+            ('/badrange', 'bytes=1000-'),
+            ('/badrange', None),
+        ])
+
+    def test_complete_partial_file(self):
+        self.part.write_bytes(BODY)
+        self.fetch('/file')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+
+    def test_retries_service_unavailable(self):
+        self.fetch('/flaky')
+        self.assertEqual(self.dest.read_bytes(), BODY)
+        self.assertEqual(len(self.server.requests), 3)
+
+    def test_gives_up_after_retries(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.fetch('/flaky', retries=1)
+        self.assertEqual(cm.exception.code, 503)
+        self.assertEqual(len(self.server.requests), 2)
+        self.assertFalse(self.dest.exists())
+
+    def test_not_found_fails_fast(self):
+        with self.assertRaises(urllib.error.HTTPError) as cm:
+            self.fetch('/missing')
+        self.assertEqual(cm.exception.code, 404)
+        self.assertEqual(len(self.server.requests), 1)
+        self.assertFalse(self.dest.exists())
+
+    def test_checksum_mismatch(self):
+        with self.assertRaisesRegex(ValueError, 'sha256 mismatch'):
+            self.fetch('/file', sha256='0' * 64, retries=2)
+        # every attempt starts over instead of resuming the bad file
+        self.assertEqual(self.server.requests, [('/file', None)] * 3)
+        self.assertFalse(self.dest.exists())
+        self.assertFalse(self.part.exists())
+
+    def test_fetch_all_reports_failures(self):
+        entries = [
+            {'url': self.base_url + '/file', 'dir': 'downloads',
+             'out': 'a/model.onnx', 'sha256': BODY_SHA256},
+            {'url': self.base_url + '/missing', 'dir': 'downloads',
+             'out': 'b/model.onnx', 'sha256': ''},
+        ]
+        etags = {}
+        failed = genpkg.fetch_all(entries, self.dest.parent, jobs=2,
+                                  retries=1, etags=etags)
+        self.assertEqual([e['out'] for e in failed], ['b/model.onnx'])
+        self.assertEqual(etags, {'a/model.onnx': '"body"'})
+        self.assertEqual(
+            (self.dest.parent / 'downloads/a/model.onnx').read_bytes(), BODY)
+
+    def test_corrupt_cache_entry_is_a_miss(self):
+        url = self.base_url + '/file'
+        http_dir = self.dest.parent / 'http'
+        http_dir.mkdir()
+        key = hashlib.sha256(url.encode()).hexdigest()
+        (http_dir / key).write_bytes(b'stale')
+        (http_dir / f'{key}.json').write_text('{"etag": "\\"bo')
+        content, how = genpkg.fetch_cached(url, self.dest.parent, timeout=5)
+        self.assertEqual((content, how), (BODY, 'fetched'))
+        self.assertEqual(self.server.requests, [('/file', None)])
+        self.assertEqual((http_dir / key).read_bytes(), BODY)
+
+
+if __name__ == '__main__':
+    unittest.main()